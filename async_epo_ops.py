@@ -0,0 +1,320 @@
+# Python 3.6+ Version - requires aiohttp (pip install aiohttp)
+
+# Asyncio variant of EPOops
+#
+# AsyncEPOops offers the main EPOops lookups as coroutines so that
+# asyncio-based services can run thousands of OPS requests in one event
+# loop without executor threads. It reads the same config.ini, shares one
+# aiohttp connection pool and access token between all tasks, paces each
+# OPS service with the same ThrottleController as EPOops and bounds the
+# number of requests in flight with a semaphore. The response cache and
+# number normaliser are shared with EPOops through EPOopsBase; their
+# SQLite lookups are local and short so they run on the event loop.
+#
+# async with AsyncEPOops() as client:
+#     async for number, response in client.get_data_many(numbers):
+#         record = client.clean_data(response)
+
+import asyncio
+import base64
+import json
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from epo_ops import BULK_BATCH_SIZE, EPOopsBase, chunked, extract_record, split_exchange_documents, split_register_documents
+from normaliser import number_service_url
+
+async def run_many_async(func, items, max_concurrency):
+    """ Async generator applying a coroutine function to each item.
+    Yields (item, result) tuples in completion order. An exception raised
+    for an item is yielded as its result rather than being raised.
+    At most 2 * max_concurrency tasks exist at any one time so that long
+    input lists are not all scheduled up front.
+    param function func: coroutine function taking a single item
+    param iterable items: items to process
+    param int max_concurrency: tasks allowed to run at once"""
+    items = iter(items)
+    pending = {}
+
+    def submit_next():
+        for item in items:
+            pending[asyncio.ensure_future(func(item))] = item
+            return True
+        return False
+
+    try:
+        while len(pending) < 2 * max_concurrency and submit_next():
+            pass
+        while pending:
+            done, _ = await asyncio.wait(list(pending), return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as error:
+                    result = error
+                submit_next()
+                yield item, result
+    finally:
+        # Cancel scheduled work if the caller stops iterating early, and wait
+        # for it to finish so no task outlives the generator
+        for future in pending:
+            future.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+class AsyncEPOops(EPOopsBase):
+    """ Coroutine version of EPOops. Use as an async context manager, or
+    call open() and close() from within the event loop."""
+
+    def __init__(self, config_file=None, max_concurrency=None):
+        """ param string config_file: config.ini to read - defaults to the one alongside epo_ops.py
+        param int max_concurrency: requests in flight at once - defaults to [Connection] POOL_MAXSIZE"""
+        if aiohttp is None:
+            raise ImportError("AsyncEPOops requires aiohttp - pip install aiohttp")
+        settings = self.configure(config_file)
+        self.timeout = aiohttp.ClientTimeout(sock_connect=settings["CONNECT_TIMEOUT"], sock_read=settings["READ_TIMEOUT"])
+        self.max_concurrency = max_concurrency or self.pool_maxsize
+
+        # Created in open() so they belong to the running event loop
+        self.session = None
+        self.semaphore = None
+        self.token_lock = None
+
+    async def open(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_maxsize)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.token_lock = asyncio.Lock()
+        return self
+
+    async def close(self):
+        """ Close the connection pool, the response cache and the number mapping table. """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        self.close_stores()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def authorise(self):
+        b64string = base64.b64encode(":".join([self.consumer_key, self.consumer_secret]).encode())
+        headers = {
+            "Authorization": "Basic %s" % b64string.decode('utf-8'),
+            "Accept": "application/json",
+            "Content-Type": "application/x-www-form-urlencoded;charset=UTF-8"
+        }
+        started = time.time()
+        async with self.session.post(self.auth_url, headers=headers, data="grant_type=client_credentials") as r:
+            ttfb = time.time() - started
+            body = await r.text()
+        self.emit(self.auth_url.replace(self.base_url, ""), "POST", r.status, len(body), {
+            "service": "auth", "started": started, "attempts": 1, "ttfb": ttfb,
+            "download": time.time() - started - ttfb
+        })
+        try:
+            self.accept_token(json.loads(body))
+        except (ValueError, KeyError):
+            print(str(r.status))
+            print(body)
+        return self.access_token
+
+    async def get_access_token(self):
+        """ Return a valid access token, authorising first if there is none or
+        it is about to expire. Only one task refreshes; the others wait for it."""
+        if self.token_valid():
+            return self.access_token
+        async with self.token_lock:
+            if not self.token_valid():
+                await self.authorise()
+            return self.access_token
+
+    async def refresh_token(self, rejected_token):
+        """ Replace a token OPS has rejected, unless another task already has. """
+        async with self.token_lock:
+            if self.access_token == rejected_token:
+                await self.authorise()
+            return self.access_token
+
+    async def fetch(self, url_portion, params=None, data=None, extra_headers=None, stats=None):
+        """ Send a request and return (status_code, headers, body text), with
+        the same throttling, token refresh and backoff as EPOops.fetch.
+        param dict stats: filled with attempts, token refreshes and timings for make_query to report"""
+        await self.open()
+        stats = {} if stats is None else stats
+        service = self.start_stats(url_portion, stats)
+        reauthorised = False
+        attempt = 0
+        while True:
+            waited = time.time()
+            delay = self.throttle.reserve(service)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            token = await self.get_access_token()
+            headers = {"Authorization": "Bearer %s" % token, "Accept": "application/json"}
+            headers.update(extra_headers or {})
+            url = self.base_url + url_portion
+            async with self.semaphore:
+                sent = time.time()
+                stats["wait"] += sent - waited
+                if data is None:
+                    request = self.session.get(url, headers=headers, params=params)
+                else:
+                    headers["Content-Type"] = "text/plain"
+                    request = self.session.post(url, headers=headers, params=params, data=data)
+                async with request as r:
+                    received = time.time()
+                    body = await r.text()
+                stats["attempts"] += 1
+                stats["ttfb"] += received - sent
+                stats["download"] += time.time() - received
+            self.throttle.update(service, r.headers)
+            action = self.retry_action(r.status, r.headers, reauthorised, attempt)
+            if action == "refresh":
+                # Get new access token and repeat request
+                await self.refresh_token(token)
+                stats["token_refreshes"] += 1
+                reauthorised = True
+                continue
+            if action == "backoff":
+                # The next reserve() waits out the pause
+                self.throttle.defer(service, attempt, r.headers.get("Retry-After"))
+                attempt += 1
+                continue
+            return r.status, r.headers, body
+
+    async def make_query(self, url_portion, params=None, data=None):
+        """ Make a query and return (status_code, parsed json) or (status_code, text).
+        Uses the response cache if one is configured - see EPOops.make_query. """
+        stats = {"started": time.time()}
+        method = "GET" if data is None else "POST"
+        cache_key, cached, extra_headers = self.cache_lookup(url_portion, params, data)
+        if cached and cached.fresh:
+            parsed = time.time()
+            response = json.loads(cached.body)
+            self.emit(url_portion, method, cached.status, len(cached.body), stats, "hit", time.time() - parsed)
+            return cached.status, response
+
+        status, headers, body = await self.fetch(url_portion, params, data, extra_headers, stats=stats)
+        status_code, response, cache, parse = self.query_result(cache_key, cached, status, body, headers)
+        self.emit(url_portion, method, status, len(body), stats, cache, parse)
+        return status_code, response
+
+    async def get_data(self, number, number_type="publication", data_type="biblio"):
+        """ Coroutine version of EPOops.get_data. """
+        data_url = "".join(["/3.1/rest-services/published-data/", number_type, "/epodoc/", number, "/", data_type])
+        status_code, response = await self.make_query(data_url)
+        return response
+
+    async def get_register(self, number, number_type="publication", data_type="biblio"):
+        """ Coroutine version of EPOops.get_register. Returns (status_code, response). """
+        data_url = "".join(["/3.1/rest-services/register/", number_type, "/epodoc/", number, "/", data_type])
+        return await self.make_query(data_url)
+
+    async def convert_number(self, country_code, application_no, filing_date=None):
+        """ Coroutine version of EPOops.convert_number. Conversions are memoised - see NumberNormaliser. """
+        application = (country_code, application_no, filing_date)
+        return (await self.application_epodoc_many([application]))[application]
+
+    async def application_epodoc_many(self, applications):
+        """ Coroutine version of NumberNormaliser.application_epodoc_many,
+        sharing its memo, mapping table and local EP parsing. """
+        applications = [tuple(application) + (None,) * (3 - len(application)) for application in applications]
+        keys, found, remote = self.numbers.pending_applications(applications)
+        definite = {}
+        async for application, result in self.as_completed(
+                lambda application: self.make_query(number_service_url(*application)), remote):
+            epodoc, known = self.numbers.application_result(result)
+            found[keys[application]] = epodoc
+            if known:
+                definite[keys[application]] = epodoc
+        self.numbers.store("application", definite)
+        return dict((application, found.get(key)) for application, key in keys.items())
+
+    async def publication_many(self, epodoc_applications):
+        """ Coroutine version of NumberNormaliser.publication_many. """
+        epodoc_applications = [number for number in epodoc_applications if number]
+        found, missing = self.numbers.pending_publications(epodoc_applications)
+        definite = {}
+        if missing:
+            async for number, response in self.get_data_bulk(missing, number_type="application"):
+                found[number], known = self.numbers.publication_result(response)
+                if known:
+                    definite[number] = found[number]
+        self.numbers.store("publication", definite)
+        return dict((number, found.get(number)) for number in epodoc_applications)
+
+    async def appln_to_pub_many(self, applications):
+        """ Coroutine version of EPOops.appln_to_pub_many. Returns a dictionary keyed by the input tuples. """
+        applications = [tuple(application) for application in applications]
+        epodocs = await self.application_epodoc_many(applications)
+        publications = await self.publication_many(epodocs.values())
+        return dict(
+            (application, publications.get(epodocs[application + (None,) * (3 - len(application))]))
+            for application in applications
+        )
+
+    async def appln_to_pub(self, country_code, application_no, filing_date=None):
+        """ Coroutine version of EPOops.appln_to_pub. Conversions are memoised - see NumberNormaliser. """
+        application = (country_code, application_no, filing_date)
+        return (await self.appln_to_pub_many([application]))[application]
+
+    def clean_data(self, data, compact=False):
+        """ See EPOops.clean_data - parsing is synchronous. """
+        return extract_record(data, compact)
+
+    def as_completed(self, func, items):
+        """ Async iterator of (item, result) for func(item) over many items,
+        in completion order. Failed items yield the raised exception. """
+        return run_many_async(func, items, self.max_concurrency)
+
+    def get_data_many(self, numbers, number_type="publication", data_type="biblio"):
+        """ Concurrent get_data. Async iterator of (number, response). """
+        return self.as_completed(lambda number: self.get_data(number, number_type, data_type), numbers)
+
+    def get_register_many(self, numbers, number_type="publication", data_type="biblio"):
+        """ Concurrent get_register. Async iterator of (number, (status_code, response)). """
+        return self.as_completed(lambda number: self.get_register(number, number_type, data_type), numbers)
+
+    async def get_data_bulk(self, numbers, number_type="publication", data_type="biblio", batch_size=BULK_BATCH_SIZE):
+        """ Bulk get_data using the multi-number POST endpoint - see EPOops.get_data_bulk.
+        Async iterator of (number, response); batches are fetched concurrently."""
+        data_url = "".join(["/3.1/rest-services/published-data/", number_type, "/epodoc/", data_type])
+
+        async def fetch_batch(batch):
+            status_code, response = await self.make_query(data_url, data=",".join(batch))
+            if status_code == 200:
+                return list(split_exchange_documents(response, batch, number_type))
+            return [(number, response) for number in batch]
+
+        async for batch, results in self.as_completed(fetch_batch, chunked(numbers, batch_size)):
+            if isinstance(results, Exception):
+                results = [(number, results) for number in batch]
+            for number, result in results:
+                yield number, result
+
+    async def get_register_bulk(self, numbers, number_type="publication", data_type="biblio", batch_size=BULK_BATCH_SIZE):
+        """ Bulk get_register. Async iterator of (number, (status_code, response)). """
+        data_url = "".join(["/3.1/rest-services/register/", number_type, "/epodoc/", data_type])
+
+        async def fetch_batch(batch):
+            status_code, response = await self.make_query(data_url, data=",".join(batch))
+            if status_code == 200:
+                return list(split_register_documents(response, batch, number_type))
+            return [(number, (status_code, response)) for number in batch]
+
+        async for batch, results in self.as_completed(fetch_batch, chunked(numbers, batch_size)):
+            if isinstance(results, Exception):
+                results = [(number, results) for number in batch]
+            for number, result in results:
+                yield number, result
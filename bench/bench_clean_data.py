@@ -0,0 +1,127 @@
+# Micro-benchmark for EPOops.clean_data
+#
+# Compares the precompiled single-pass extractor with the previous
+# safeget based implementation on a corpus built from the biblio fixtures.
+#
+# Usage: python bench/bench_clean_data.py [number of records]
+
+from __future__ import print_function
+
+import glob
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from epo_ops import safeget, check_list, extract_record
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "biblio")
+
+def load_fixtures():
+    """ Parsed biblio fixtures in filename order. """
+    fixtures = []
+    for filename in sorted(glob.glob(os.path.join(FIXTURES, "*.json"))):
+        with open(filename) as f:
+            fixtures.append(json.load(f))
+    return fixtures
+
+def load_corpus(size):
+    """ Repeat the biblio fixtures to build a corpus of size responses. """
+    fixtures = load_fixtures()
+    return [fixtures[i % len(fixtures)] for i in range(size)]
+
+def legacy_clean_data(data):
+    """ clean_data as implemented before the precompiled extractor, kept as the
+    baseline for this benchmark. """
+
+    cleaned_data = {}
+
+    # Check data relates to located document
+    data_to_check = safeget(data, "ops:world-patent-data", "exchange-documents", "exchange-document")
+    if isinstance(data_to_check, dict):
+        if data_to_check.get("@status") == "not found":
+            return "Error: document not found"
+        else:
+            exdoc = data_to_check
+    else:
+        if isinstance(data_to_check, list) and (len(data_to_check) > 0):
+            exdoc = data_to_check[0]
+        else:
+            return "Error: document not found"
+
+    title_list = check_list(safeget(exdoc, "bibliographic-data", "invention-title"))
+    cleaned_data["title"] = [title.get("$", None) for title in title_list if title.get("@lang", None) == "en"][0]
+
+    publication = check_list(safeget(exdoc, "bibliographic-data", "publication-reference", "document-id"))
+
+    cleaned_data["publication"] = [
+        {
+            "number": safeget(pub_record, "doc-number", "$"), 
+            "date": safeget(pub_record, "date", "$")
+        } for pub_record in publication if (pub_record.get("@document-id-type", None) == "epodoc")]
+
+    cleaned_data["applicants"] = [safeget(applicant, "applicant-name", "name", "$") for applicant in safeget(exdoc, "bibliographic-data", "parties", "applicants", "applicant") if applicant.get("@data-format", None) == "epodoc"]
+
+    cleaned_data["inventors"] = [safeget(inventor, "inventor-name", "name", "$") for inventor in safeget(exdoc, "bibliographic-data", "parties", "inventors", "inventor") if inventor.get("@data-format", None) == "epodoc"]
+
+    cleaned_data["application"] = [{"number": safeget(appln_record, "doc-number", "$"), "date": safeget(appln_record, "date", "$")} for appln_record in safeget(exdoc, "bibliographic-data", "application-reference", "document-id") if appln_record.get("@document-id-type", None) == "epodoc"]
+
+    priority_list = check_list(safeget(exdoc, "bibliographic-data", "priority-claims", "priority-claim"))
+    cleaned_data["priorityclaims"] = []
+    for priority in priority_list:
+        for p_record in check_list(priority.get("document-id", None)):
+            if p_record.get("@document-id-type", None) == "epodoc":
+                cleaned_data["priorityclaims"].append({"number": safeget(p_record, "doc-number", "$"), "date": safeget(p_record, "date", "$")})
+
+    cleaned_data["classifications"] = [
+    {
+        "section" : safeget(classification, "section", "$"), 
+        "class" : safeget(classification, "class", "$") ,
+        "subclass" : safeget(classification, "subclass", "$"),
+        "maingroup": safeget(classification, "main-group", "$"),
+        "subgroup" : safeget(classification, "subgroup", "$")
+    } for classification in safeget(exdoc, "bibliographic-data", "patent-classifications", "patent-classification")]
+
+    cleaned_data["abstract"] = safeget(exdoc, "abstract", "p", "$")
+
+    cleaned_data["citations"] = []
+    pub_list = []
+    for document in check_list(data_to_check):
+        if "references-cited" in document.get("bibliographic-data", None):
+            citation_list = check_list(safeget(document, "bibliographic-data", "references-cited", "citation"))
+            for citation in citation_list:
+                for c_record in check_list(safeget(citation, "patcit", "document-id")):
+                    if c_record:
+                        if (c_record.get("@document-id-type", None) == "epodoc") and (safeget(c_record, "doc-number", "$") not in pub_list):
+                            cleaned_citation = {}
+                            cleaned_citation["number"] = safeget(c_record, "doc-number", "$")
+                            pub_list.append(safeget(c_record,"doc-number","$"))
+                            if "date" in c_record:
+                                cleaned_citation["date"] = safeget(c_record, "date", "$")
+                            if "category" in citation:
+                                cleaned_citation["category"] = safeget(citation, "category", "$")
+                            cleaned_data["citations"].append(cleaned_citation)            
+
+    return cleaned_data
+
+
+def records_per_second(func, corpus, repeat=5):
+    """ Best of repeat runs of func over the corpus. """
+    best = min(timeit.repeat(lambda: [func(data) for data in corpus], number=1, repeat=repeat))
+    return len(corpus) / best
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    corpus = load_corpus(size)
+    # Every fixture must give the same output as the baseline
+    for data in load_fixtures():
+        assert legacy_clean_data(data) == extract_record(data), "extractor output differs from baseline"
+    before = records_per_second(legacy_clean_data, corpus)
+    after = records_per_second(extract_record, corpus)
+    compact = records_per_second(lambda data: extract_record(data, compact=True), corpus)
+    print("records: %d" % size)
+    print("before (safeget):      %10.0f records/s" % before)
+    print("after (extractor):     %10.0f records/s  x%.2f" % (after, after / before))
+    print("after (compact):       %10.0f records/s  x%.2f" % (compact, compact / before))
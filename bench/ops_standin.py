@@ -0,0 +1,364 @@
+# Local stand-in for the EPO OPS service used by the offline benchmarks
+#
+# Serves the recorded responses in bench/fixtures over plain HTTP and mimics
+# the parts of OPS that affect client performance: response latency,
+# X-Throttling-Control and quota headers, per-service rate limits and
+# access token expiry.
+#
+# Usage: python bench/ops_standin.py [--port 0] [--latency 50] [--rate 6000] [--token-lifetime 1199]
+# The first line written to stdout is the base url the server listens on.
+
+from __future__ import print_function
+
+import argparse
+import copy
+import glob
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:
+    from urlparse import parse_qs
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from epo_ops import ops_service, check_list, KIND_CODE_RE
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+SERVICES = ["images", "inpadoc", "other", "retrieval", "search"]
+
+PUBLISHED_RE = re.compile(r"^/3\.1/rest-services/published-data/(publication|application|priority)/epodoc/(?:([^/]+)/)?(biblio|claims|description|equivalents)$")
+SEARCH_RE = re.compile(r"^/3\.1/rest-services/published-data/search$")
+REGISTER_RE = re.compile(r"^/3\.1/rest-services/register/(publication|application)/epodoc/(?:([^/]+)/)?biblio$")
+NUMBER_RE = re.compile(r"^/3\.1/rest-services/number-service/application/original/([A-Z]{2})\.\(([^)]*)\)(?:\.[0-9]+)?/epodoc$")
+AUTH_RE = re.compile(r"/auth/accesstoken$")
+
+
+def load_fixture(*parts):
+    with open(os.path.join(FIXTURES, *parts)) as f:
+        return f.read()
+
+
+class Fixtures():
+    """ Recorded responses, rewritten so returned documents carry the requested number.
+    Biblio documents are serialised once with placeholders so that serving
+    them costs a string replace rather than a deep copy."""
+
+    def __init__(self):
+        self.biblio = [
+            json.loads(load_fixture("biblio", os.path.basename(filename)))
+            for filename in sorted(glob.glob(os.path.join(FIXTURES, "biblio", "*.json")))
+        ]
+        self.templates = dict(
+            (number_type, [self.biblio_template(biblio, number_type) for biblio in self.biblio])
+            for number_type in ["publication", "application", "priority"]
+        )
+        self.register = json.loads(load_fixture("register", "EP1000001.json"))
+        self.auth = json.loads(load_fixture("auth", "accesstoken.json"))
+        self.number = json.loads(load_fixture("number-service", "application.json"))
+        self.fulltext = {
+            ("claims", "json"): load_fixture("claims", "EP1000001.json"),
+            ("claims", "xml"): load_fixture("claims", "EP1000001.xml"),
+            ("description", "json"): load_fixture("description", "EP1000001.json"),
+            ("description", "xml"): load_fixture("description", "EP1000001.xml")
+        }
+
+    def biblio_template(self, response, number_type):
+        """ Serialised exchange-documents with the requested number replaced by placeholders. """
+        documents = check_list(copy.deepcopy(
+            response["ops:world-patent-data"]["exchange-documents"]["exchange-document"]))
+        for exdoc in documents:
+            biblio = exdoc["bibliographic-data"]
+            if number_type == "application":
+                references = biblio["application-reference"]["document-id"]
+            elif number_type == "priority":
+                references = check_list(biblio["priority-claims"]["priority-claim"])[0]["document-id"]
+            else:
+                exdoc["@country"], exdoc["@doc-number"] = "__COUNTRY__", "__DOCNUMBER__"
+                references = biblio["publication-reference"]["document-id"]
+            for record in check_list(references):
+                if record.get("@document-id-type") == "epodoc":
+                    record["doc-number"]["$"] = "__NUMBER__"
+        return [json.dumps(exdoc) for exdoc in documents]
+
+    def exchange_documents(self, number, number_type):
+        """ Serialised exchange-documents for a number, based on one of the biblio fixtures. """
+        number = number.strip().replace(".", "").upper()
+        match = KIND_CODE_RE.match(number)
+        if match:
+            number = match.group(1)
+        templates = self.templates[number_type]
+        return [
+            document.replace("__NUMBER__", number).replace("__COUNTRY__", number[:2]).replace("__DOCNUMBER__", number[2:])
+            for document in templates[sum(ord(c) for c in number) % len(templates)]
+        ]
+
+    def biblio_response(self, numbers, number_type):
+        documents = []
+        for number in numbers:
+            documents.extend(self.exchange_documents(number, number_type))
+        if len(documents) == 1:
+            documents = documents[0]
+        else:
+            documents = "[%s]" % ", ".join(documents)
+        return '{"ops:world-patent-data": {"exchange-documents": {"exchange-document": %s}}}' % documents
+
+    def related_numbers(self, number, count):
+        """ Deterministic pseudo-random publication numbers related to a number,
+        so that graph crawls reach a bounded but non-trivial neighbourhood. """
+        seed = sum(ord(c) * (i + 1) for i, c in enumerate(number))
+        return ["EP%d" % (1000000 + (seed * (i + 7) * 7919) % 5000) for i in range(count)]
+
+    def references(self, numbers):
+        return [
+            {"document-id": {"@document-id-type": "docdb", "country": {"$": number[:2]},
+                             "doc-number": {"$": number[2:]}, "kind": {"$": "A1"}}}
+            for number in numbers
+        ]
+
+    def search_response(self, query, range_header):
+        """ Forward citation search - only ct=<number> queries are supported. """
+        if not query.startswith("ct="):
+            return 404, "<fault><code>SERVER.EntityNotFound</code></fault>", "application/xml"
+        citing = self.related_numbers(query[3:], 3)
+        begin, end = [int(value) for value in (range_header or "1-25").split("-")]
+        references = self.references(citing[begin - 1:end])
+        return 200, {"ops:world-patent-data": {"ops:biblio-search": {
+            "@total-result-count": str(len(citing)),
+            "ops:range": {"@begin": str(begin), "@end": str(end)},
+            "ops:search-result": {"ops:publication-reference": references}
+        }}}, "application/json"
+
+    def equivalents_response(self, number):
+        results = [{"publication-reference": reference} for reference in self.references(self.related_numbers(number[::-1], 2))]
+        return {"ops:world-patent-data": {"ops:equivalents-inquiry": {
+            "ops:publication-reference": self.references([number])[0],
+            "ops:inquiry-result": results
+        }}}
+
+    def number_response(self, country, number):
+        """ Number-service conversion whose epodoc output depends on the requested number. """
+        digits = re.sub(r"[^0-9]", "", number) or "0"
+        response = copy.deepcopy(self.number)
+        standardization = response["ops:world-patent-data"]["ops:standardization"]
+        source = standardization["ops:input"]["ops:application-reference"]["document-id"]
+        source["country"]["$"], source["doc-number"]["$"] = country, number
+        output = standardization["ops:output"]["ops:application-reference"]["document-id"]
+        output["doc-number"]["$"] = "%s2013%s" % (country, digits[-7:].zfill(7))
+        return response
+
+    def register_response(self, numbers):
+        documents = []
+        template = self.register["ops:world-patent-data"]["ops:register-search"]["reg:register-documents"]["reg:register-document"]
+        for number in numbers:
+            regdoc = copy.deepcopy(template)
+            reference = regdoc["reg:bibliographic-data"]["reg:publication-reference"][0]["reg:document-id"]
+            reference["reg:country"]["$"], reference["reg:doc-number"]["$"] = number[:2], number[2:]
+            documents.append(regdoc)
+        response = copy.deepcopy(self.register)
+        response["ops:world-patent-data"]["ops:register-search"]["reg:register-documents"]["reg:register-document"] = (
+            documents[0] if len(documents) == 1 else documents)
+        return response
+
+
+class StandinState():
+    """ Tokens, per-service request windows and quota usage shared by all handlers. """
+
+    def __init__(self, latency, jitter, rate, token_lifetime):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate = rate
+        self.token_lifetime = token_lifetime
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.windows = dict((service, deque()) for service in SERVICES)
+        self.bytes_served = 0
+
+    def issue_token(self):
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = time.time() + self.token_lifetime
+        return token
+
+    def token_valid(self, authorization):
+        token = (authorization or "")[len("Bearer "):]
+        with self.lock:
+            return self.tokens.get(token, 0) > time.time()
+
+    def admit(self, service):
+        """ Record a request and return (allowed, throttling header). """
+        now = time.time()
+        with self.lock:
+            window = self.windows[service]
+            while window and window[0] < now - 60:
+                window.popleft()
+            allowed = len(window) < self.rate
+            if allowed:
+                window.append(now)
+            parts = []
+            for name in SERVICES:
+                used = len(self.windows[name]) / float(self.rate)
+                if name == service and not allowed:
+                    colour = "black"
+                elif used < 0.5:
+                    colour = "green"
+                elif used < 0.75:
+                    colour = "yellow"
+                else:
+                    colour = "red"
+                parts.append("%s=%s:%d" % (name, colour, self.rate))
+            busiest = max(len(window) for window in self.windows.values()) / float(self.rate)
+        state = "idle" if busiest < 0.5 else "busy" if busiest < 0.9 else "overloaded"
+        return allowed, "%s (%s)" % (state, ", ".join(parts))
+
+    def served(self, size):
+        with self.lock:
+            self.bytes_served += size
+            return self.bytes_served
+
+    def delay(self):
+        if self.latency:
+            time.sleep(max(0, random.gauss(self.latency, self.jitter)) / 1000.0)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; avoid delayed-ACK stalls on keep-alive
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        return body.decode("utf-8")
+
+    def do_POST(self):
+        self.handle_request(self.read_body())
+
+    def do_GET(self):
+        self.handle_request(None)
+
+    def handle_request(self, body):
+        state = self.server.state
+        path, _, query = self.path.partition("?")
+        state.delay()
+
+        if AUTH_RE.search(path):
+            token = dict(self.server.fixtures.auth, access_token=state.issue_token(),
+                         expires_in=str(state.token_lifetime))
+            return self.reply(200, json.dumps(token))
+
+        if not state.token_valid(self.headers.get("Authorization")):
+            return self.reply(400, "<fault><code>CLIENT.InvalidAccessToken</code>"
+                                   "<message>invalid_access_token</message></fault>", "application/xml")
+
+        service = ops_service(path)
+        allowed, throttling = state.admit(service)
+        headers = {"X-Throttling-Control": throttling}
+        if not allowed:
+            headers["Retry-After"] = "1"
+            return self.reply(403, "<fault><code>SERVER.DomainAccess</code></fault>", "application/xml", headers)
+
+        status, response, content_type = self.route(path, body, parse_qs(query))
+        if not isinstance(response, str):
+            response = json.dumps(response)
+        used = str(state.served(len(response)))
+        headers["X-IndividualQuotaPerHour-Used"] = used
+        headers["X-RegisteredQuotaPerWeek-Used"] = used
+        self.reply(status, response, content_type, headers)
+
+    def route(self, path, body, query):
+        """ Return (status, response, content type) for a data request. """
+        fixtures = self.server.fixtures
+        numbers = [number for number in (body or "").split(",") if number.strip()]
+
+        match = PUBLISHED_RE.match(path)
+        if match:
+            number_type, number, data_type = match.groups()
+            if data_type == "biblio":
+                return 200, fixtures.biblio_response(numbers or [number], number_type), "application/json"
+            if data_type == "equivalents":
+                return 200, fixtures.equivalents_response(number), "application/json"
+            if "xml" in (self.headers.get("Accept") or ""):
+                return 200, fixtures.fulltext[(data_type, "xml")], "application/xml"
+            return 200, fixtures.fulltext[(data_type, "json")], "application/json"
+
+        if SEARCH_RE.match(path):
+            return fixtures.search_response((query.get("q") or [""])[0], (query.get("Range") or [None])[0])
+
+        match = REGISTER_RE.match(path)
+        if match:
+            return 200, fixtures.register_response(numbers or [match.group(2)]), "application/json"
+
+        match = NUMBER_RE.match(path)
+        if match:
+            return 200, fixtures.number_response(*match.groups()), "application/json"
+
+        return 404, "<fault><code>SERVER.EntityNotFound</code></fault>", "application/xml"
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, state):
+        HTTPServer.__init__(self, address, StandinHandler)
+        self.state = state
+        self.fixtures = Fixtures()
+
+    @property
+    def base_url(self):
+        return "http://%s:%d" % self.server_address[:2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the EPO OPS service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="0 picks a free port")
+    parser.add_argument("--latency", type=float, default=50.0, help="mean response latency in ms")
+    parser.add_argument("--jitter", type=float, default=10.0, help="standard deviation of latency in ms")
+    parser.add_argument("--rate", type=int, default=6000, help="requests per minute allowed per service")
+    parser.add_argument("--token-lifetime", type=int, default=1199, help="access token lifetime in seconds")
+    args = parser.parse_args()
+
+    state = StandinState(args.latency, args.jitter, args.rate, args.token_lifetime)
+    server = StandinServer((args.host, args.port), state)
+    print(server.base_url)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# Offline benchmark suite for EPOops
+#
+# Starts bench/ops_standin.py in a subprocess and runs the main EPOops
+# workloads against it, reporting throughput, p50/p95/p99 latency and peak
+# Python memory (tracemalloc) for each. No network access or OPS quota is
+# needed, so the suite can run in CI to catch performance regressions.
+#
+# Usage: python bench/run_benchmarks.py [--count 200] [--workers 8] [--no-memory] [--metrics] [--json] [scenario ...]
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from epo_ops import EPOops, run_many, extract_record
+from classifications import ClassificationCounter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CONFIG = """[Login Parameters]
+C_KEY = bench
+C_SECRET = bench
+
+[URLs]
+HOST = {host}
+AUTH_URL = {base_url}/3.1/auth/accesstoken
+BASE_URL = {base_url}
+
+[Connection]
+POOL_MAXSIZE = {workers}
+"""
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of a list of numbers. """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1)]
+
+def timed(func):
+    """ Wrap func so it returns (seconds taken, error or None). """
+    def call(item):
+        start = time.perf_counter()
+        try:
+            func(item)
+            error = None
+        except Exception as e:
+            error = e
+        return time.perf_counter() - start, error
+    return call
+
+def measure(name, func, items, workers=1, memory=True):
+    """ Run func over items, sequentially or on a thread pool, and return a result row.
+    Tracing memory slows allocation-heavy scenarios, so it can be switched off
+    for timing-only runs."""
+    items = list(items)
+    call = timed(func)
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    if workers > 1:
+        results = [result for item, result in run_many(call, items, workers)]
+    else:
+        results = [call(item) for item in items]
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    latencies = [seconds for seconds, error in results]
+    return {
+        "scenario": name,
+        "count": len(items),
+        "errors": sum(1 for seconds, error in results if error is not None),
+        "throughput": len(items) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "peak_kb": peak / 1024.0
+    }
+
+def scenarios(client, numbers, workers):
+    """ (name, func, items, workers) for each benchmark scenario.
+    items may be a function, called only if the scenario is selected."""
+    counter = ClassificationCounter()
+    return [
+        ("get_data", client.get_data, numbers, 1),
+        ("get_data_many", client.get_data, numbers, workers),
+        ("get_data_bulk", lambda batch: list(client.get_data_bulk(batch)),
+            [numbers[i:i + 100] for i in range(0, len(numbers), 100)], 1),
+        ("clean_data", extract_record, lambda: [client.get_data(number) for number in numbers[:50]] * 20, 1),
+        ("get_published_claims", client.get_published_claims, numbers, workers),
+        ("iter_published_desc", lambda number: sum(1 for p in client.iter_published_desc(number)), numbers, workers),
+        ("appln_to_pub", lambda number: client.appln_to_pub("EP", number[2:]), numbers, workers),
+        ("classifications", lambda number: counter.add_document(client.clean_data(client.get_data(number))),
+            numbers, workers)
+    ]
+
+def start_standin(args):
+    """ Start the stand-in server and return (process, base url). """
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "ops_standin.py"),
+         "--latency", str(args.latency), "--jitter", str(args.jitter),
+         "--rate", str(args.rate), "--token-lifetime", str(args.token_lifetime)],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    return process, process.stdout.readline().strip()
+
+def print_table(rows):
+    print("%-22s %7s %6s %10s %9s %9s %9s %10s" % (
+        "scenario", "count", "errors", "ops/s", "p50 ms", "p95 ms", "p99 ms", "peak KB"))
+    for row in rows:
+        print("%-22s %7d %6d %10.1f %9.2f %9.2f %9.2f %10.1f" % (
+            row["scenario"], row["count"], row["errors"], row["throughput"],
+            row["p50_ms"], row["p95_ms"], row["p99_ms"], row["peak_kb"]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline EPOops benchmarks against a local OPS stand-in")
+    parser.add_argument("scenario", nargs="*", help="scenarios to run - default all")
+    parser.add_argument("--count", type=int, default=200, help="numbers per scenario")
+    parser.add_argument("--workers", type=int, default=8, help="threads for concurrent scenarios")
+    parser.add_argument("--latency", type=float, default=20.0, help="stand-in mean latency in ms")
+    parser.add_argument("--jitter", type=float, default=5.0, help="stand-in latency standard deviation in ms")
+    parser.add_argument("--rate", type=int, default=60000, help="stand-in requests per minute per service")
+    parser.add_argument("--token-lifetime", type=int, default=1199, help="stand-in token lifetime in seconds")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc peak memory measurement")
+    parser.add_argument("--metrics", action="store_true", help="also report per-endpoint request metrics")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    process, base_url = start_standin(args)
+    config_file = tempfile.NamedTemporaryFile("w", suffix=".ini", delete=False)
+    try:
+        config_file.write(CONFIG.format(host=base_url.split("//", 1)[1], base_url=base_url, workers=args.workers))
+        config_file.close()
+        with EPOops(config_file.name) as client:
+            metrics = client.enable_metrics() if args.metrics else None
+            numbers = ["EP%d" % (1000000 + i) for i in range(args.count)]
+            rows = [
+                measure(name, func, items() if callable(items) else items, workers, not args.no_memory)
+                for name, func, items, workers in scenarios(client, numbers, args.workers)
+                if not args.scenario or name in args.scenario
+            ]
+            quota = client.quota_usage()
+    finally:
+        os.unlink(config_file.name)
+        process.terminate()
+        process.wait()
+
+    if args.json:
+        output = {"results": rows, "quota": quota}
+        if metrics is not None:
+            output["metrics"] = metrics.snapshot()
+        print(json.dumps(output, indent=1))
+    else:
+        print_table(rows)
+        if metrics is not None:
+            print()
+            print(metrics.dump_text())
+    return 1 if any(row["errors"] for row in rows) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
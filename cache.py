@@ -0,0 +1,145 @@
+# Python 2.7 and 3+ Version
+
+# Persistent response cache for EPOops and AsyncEPOops
+#
+# Successful OPS responses are kept in SQLite with a TTL per kind of
+# request, and expired entries are revalidated with ETag / Last-Modified
+# where OPS supplied them.
+
+from __future__ import print_function
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+# Response cache defaults - set PATH in the [Cache] section of config.ini to enable
+# TTLs are in seconds, keyed by the cache category of the request url
+CACHE_DEFAULTS = {
+    "PATH": "",
+    "MAX_BYTES": 512 * 1024 * 1024,
+    "TTL_BIBLIO": 30 * 24 * 3600,
+    "TTL_FULLTEXT": 90 * 24 * 3600,
+    "TTL_REGISTER": 24 * 3600,
+    "TTL_NUMBER": 365 * 24 * 3600,
+    "TTL_SEARCH": 24 * 3600,
+    "TTL_DEFAULT": 7 * 24 * 3600
+}
+
+def cache_category(url_portion):
+    """ Cache category of a request url, used to select its TTL. """
+    if "/register/" in url_portion:
+        return "register"
+    if "/number-service/" in url_portion:
+        return "number"
+    if "/published-data/search" in url_portion:
+        # Search results change as new documents are published
+        return "search"
+    if re.search(r"/(claims|description|fulltext)$", url_portion):
+        return "fulltext"
+    if "/published-data/" in url_portion:
+        return "biblio"
+    return "default"
+
+CachedResponse = namedtuple("CachedResponse", ["status", "body", "etag", "last_modified", "fresh"])
+
+
+class ResponseCache():
+    """ Persistent SQLite cache of successful OPS responses.
+    Entries are keyed on url, params and POST body, expire after a TTL that
+    depends on the cache category of the url, and are evicted least recently
+    used first once the stored bodies exceed max_bytes. Expired entries with
+    an ETag or Last-Modified header are kept for conditional revalidation.
+    Safe to share between threads."""
+    
+    def __init__(self, path, max_bytes=CACHE_DEFAULTS["MAX_BYTES"], ttls=None):
+        """ param string path: SQLite database file
+        param int max_bytes: size cap for stored response bodies
+        param dict ttls: cache category -> seconds, see cache_category"""
+        self.max_bytes = max_bytes
+        self.ttls = ttls or {}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, status INTEGER, body TEXT, etag TEXT, last_modified TEXT, "
+            "stored REAL, accessed REAL, size INTEGER)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    
+    def make_key(self, url_portion, params=None, data=None):
+        """ Stable key for a request. """
+        parts = [url_portion, json.dumps(sorted((params or {}).items())), data or ""]
+        return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+    
+    def ttl(self, url_portion):
+        category = cache_category(url_portion)
+        return self.ttls.get(category, self.ttls.get("default", CACHE_DEFAULTS["TTL_DEFAULT"]))
+    
+    def get(self, key, ttl):
+        """ Return a CachedResponse for key, or None if not cached.
+        Expired entries are returned with fresh=False if they can be revalidated."""
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status, body, etag, last_modified, stored FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            status, body, etag, last_modified, stored = row
+            fresh = now - stored < ttl
+            if not fresh and not (etag or last_modified):
+                self.delete(key)
+                return None
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+        return CachedResponse(status, body, etag, last_modified, fresh)
+    
+    def put(self, key, status, body, etag=None, last_modified=None):
+        """ Store a response body and evict old entries if over the size cap. """
+        now = time.time()
+        size = len(body.encode("utf-8"))
+        with self.lock:
+            self.delete(key)
+            self.conn.execute(
+                "INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, status, body, etag, last_modified, now, now, size))
+            self.total_bytes += size
+            self.evict()
+            self.conn.commit()
+    
+    def touch(self, key):
+        """ Mark an entry as fresh again after a 304 Not Modified response. """
+        now = time.time()
+        with self.lock:
+            self.conn.execute("UPDATE responses SET stored = ?, accessed = ? WHERE key = ?", (now, now, key))
+            self.conn.commit()
+    
+    def delete(self, key):
+        """ Remove an entry. Caller holds the lock. """
+        row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row:
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.total_bytes -= row[0]
+    
+    def evict(self):
+        """ Drop least recently used entries until under max_bytes. Caller holds the lock. """
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT key, size FROM responses ORDER BY accessed LIMIT 100").fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            for key, size in rows:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
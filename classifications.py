@@ -0,0 +1,437 @@
+# Python 2.7 and 3+ Version
+
+# Streaming aggregation of patent classifications
+#
+# Counts section / class / subclass / main-group / subgroup as documents
+# arrive, producing the same upper_dict as process_classifications.py
+# without building an intermediate DOM or save_doc.xml.
+
+from __future__ import print_function
+
+import heapq
+import os
+import pickle
+import re
+from xml.etree import ElementTree
+
+from epo_ops import extract_record, local_name
+
+# Classification levels in hierarchy order - also the keys of upper_dict
+LEVELS = ['section', 'class', 'subclass', 'main-group', 'subgroup']
+
+# clean_data / PatentRecord field names for each level
+CLEAN_DATA_LEVELS = ['section', 'class', 'subclass', 'maingroup', 'subgroup']
+
+
+class ClassificationCounter():
+    """ Running counts of classification codes at each level.
+    Each level is keyed by the concatenation of the values down to it, e.g.
+    upper_dict['subclass']['G06F'], as in process_classifications.py. Memory
+    grows with the number of distinct codes, not the number of documents."""
+
+    def __init__(self, upper_dict=None):
+        self.upper_dict = upper_dict if upper_dict is not None else {}
+        self.documents = 0
+
+    def add(self, levels):
+        """ Count one classification.
+        param list levels: values for section, class, subclass, main-group, subgroup"""
+        class_level_val = ""
+        for tag, value in zip(LEVELS, levels):
+            if not value:
+                break
+            class_level_val = class_level_val + value.strip()
+            counts = self.upper_dict.setdefault(tag, {})
+            counts[class_level_val] = counts.get(class_level_val, 0) + 1
+
+    def add_document(self, cleaned_data):
+        """ Count the classifications of a document cleaned by EPOops.clean_data.
+        param cleaned_data: dictionary or PatentRecord"""
+        if isinstance(cleaned_data, dict):
+            classifications = cleaned_data["classifications"]
+            for classification in classifications:
+                self.add([classification[level] for level in CLEAN_DATA_LEVELS])
+        else:
+            for classification in cleaned_data.classifications:
+                self.add(classification)
+        self.documents += 1
+
+    def add_xml(self, source):
+        """ Incrementally parse biblio XML and count its patent-classification elements.
+        Only the first exchange-document is counted, as in plot_cases.py; elements
+        outside any exchange-document (e.g. an old save_doc.xml) are all counted.
+        Parsed elements are discarded as they close.
+        Returns the classification-ipcr strings of the first exchange-document.
+        param file source: file name or file-like object"""
+        ipcr = []
+        stack = []
+        exdoc_index = 0
+        levels = {}
+        for event, elem in ElementTree.iterparse(source, events=("start", "end")):
+            name = local_name(elem.tag)
+            if event == "start":
+                stack.append(elem)
+                if name == "exchange-document":
+                    exdoc_index += 1
+                continue
+            stack.pop()
+            counted = exdoc_index <= 1
+            if name in LEVELS and counted:
+                levels[name] = elem.text
+            elif name == "patent-classification":
+                if counted:
+                    self.add([levels.get(tag) for tag in LEVELS])
+                levels = {}
+            elif name == "text" and counted and stack and local_name(stack[-1].tag) == "classification-ipcr":
+                ipcr.append(elem.text)
+            elif name == "exchange-document" and exdoc_index == 1:
+                self.documents += 1
+            if stack and name in ("patent-classification", "classification-ipcr", "exchange-document"):
+                stack[-1].remove(elem)
+        return ipcr
+
+    def save(self, filename):
+        """ Pickle upper_dict, e.g. to results.pkl. """
+        with open(filename, "wb") as f:
+            pickle.dump(self.upper_dict, f)
+
+
+def aggregate(documents, emit_every=1000, counter=None):
+    """ Generator counting classifications as cleaned documents arrive.
+    Yields (documents counted, upper_dict) every emit_every documents and once
+    at the end, so callers can report or save progress while a long portfolio
+    is still being fetched. The same upper_dict is updated in place.
+    param iterable documents: output of EPOops.clean_data, e.g. from get_data_many
+    param int emit_every: documents between yields"""
+    counter = counter or ClassificationCounter()
+    for cleaned_data in documents:
+        if isinstance(cleaned_data, str):
+            # clean_data error message such as "Error: document not found"
+            continue
+        counter.add_document(cleaned_data)
+        if counter.documents % emit_every == 0:
+            yield counter.documents, counter.upper_dict
+    if counter.documents % emit_every:
+        yield counter.documents, counter.upper_dict
+
+
+# Classification code such as "G06F 16/30", "G06F16" or "H04"
+CODE_RE = re.compile(r"^\s*([A-HY])\s*([0-9]{2})?\s*([A-Z])?\s*([0-9]{1,4})?\s*(?:/\s*([0-9]{1,6}))?\s*$")
+
+def parse_code(code):
+    """ Split a classification code or prefix into its levels.
+    e.g. "G06F 16/30" -> ["G", "06", "F", "16", "30"], "H04" -> ["H", "04"]
+    param code: string, or a list / tuple of levels which is returned unchanged"""
+    if not isinstance(code, str):
+        return [level for level in code if level]
+    match = CODE_RE.match(code.upper())
+    if not match:
+        raise ValueError("Not a classification code: %r" % code)
+    return [level for level in match.groups() if level]
+
+
+class IndexNode(object):
+    """ One level of a classification in a ClassificationIndex. """
+
+    __slots__ = ("children", "count", "documents")
+
+    def __init__(self):
+        self.children = {}
+        self.count = 0
+        self.documents = set()
+
+
+class ClassificationIndex():
+    """ Hierarchical CPC/IPC index keyed section -> class -> subclass ->
+    main group -> subgroup. Each node holds the number of classifications
+    counted under it and the ids of the documents they came from, so
+    "all documents under G06F 16" or "top subclasses under H04" are answered
+    with a walk of at most five dictionary lookups rather than a scan of
+    every code."""
+
+    def __init__(self):
+        self.root = IndexNode()
+
+    def add(self, levels, doc_id=None):
+        """ Count one classification for a document.
+        param list levels: section, class, subclass, main group, subgroup values
+        param doc_id: document identifier, e.g. publication number"""
+        node = self.root
+        node.count += 1
+        if doc_id is not None:
+            node.documents.add(doc_id)
+        for level in levels:
+            if not level:
+                break
+            level = level.strip()
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = IndexNode()
+            node = child
+            node.count += 1
+            if doc_id is not None:
+                node.documents.add(doc_id)
+
+    def remove(self, levels, doc_id=None):
+        """ Undo add() for one classification of a document. The document id is
+        dropped from every node on the path, so remove all of a document's
+        classifications together. Nodes left empty are pruned. Does nothing
+        if the classification was never indexed.
+        Returns True if a classification was removed."""
+        path = [self.root]
+        for level in levels:
+            if not level:
+                break
+            child = path[-1].children.get(level.strip())
+            if child is None:
+                return False
+            path.append(child)
+        # Classifications ending at the last node, rather than passing through it
+        leaf = path[-1]
+        if len(path) == 1 or leaf.count - sum(child.count for child in leaf.children.values()) <= 0:
+            return False
+        for node in path:
+            node.count -= 1
+            if doc_id is not None:
+                node.documents.discard(doc_id)
+        for depth in range(len(path) - 1, 0, -1):
+            if path[depth].count <= 0:
+                del path[depth - 1].children[levels[depth - 1].strip()]
+        return True
+    
+    def add_document(self, cleaned_data, doc_id=None):
+        """ Index the classifications of a document cleaned by EPOops.clean_data.
+        param cleaned_data: dictionary or PatentRecord
+        param doc_id: defaults to the first publication number"""
+        if isinstance(cleaned_data, dict):
+            publication = cleaned_data["publication"]
+            if doc_id is None and publication:
+                doc_id = publication[0]["number"]
+            for classification in cleaned_data["classifications"]:
+                self.add([classification[level] for level in CLEAN_DATA_LEVELS], doc_id)
+        else:
+            if doc_id is None and cleaned_data.publication:
+                doc_id = cleaned_data.publication[0].number
+            for classification in cleaned_data.classifications:
+                self.add(classification, doc_id)
+
+    def node(self, code):
+        """ Node for a code or prefix, or None if nothing is indexed under it. """
+        node = self.root
+        for level in parse_code(code):
+            node = node.children.get(level)
+            if node is None:
+                return None
+        return node
+
+    def count(self, code):
+        """ Number of classifications counted under a code or prefix. """
+        node = self.node(code)
+        return node.count if node else 0
+
+    def documents(self, code):
+        """ Ids of documents with a classification under a code or prefix, e.g. "G06F 16". """
+        node = self.node(code)
+        return set(node.documents) if node else set()
+
+    def children(self, code=()):
+        """ Dictionary of full code -> count for the next level under a code or prefix. """
+        levels = parse_code(code)
+        node = self.node(levels)
+        if node is None:
+            return {}
+        return dict((format_code(levels + [level]), child.count) for level, child in node.children.items())
+
+    def top(self, code=(), n=10, by_documents=False):
+        """ The n largest (code, count) pairs at the next level under a code or
+        prefix, e.g. top("H04", 5) gives the five largest subclasses in H04.
+        param bool by_documents: rank by number of documents instead of classifications"""
+        levels = parse_code(code)
+        node = self.node(levels)
+        if node is None:
+            return []
+        key = (lambda item: len(item[1].documents)) if by_documents else (lambda item: item[1].count)
+        return [
+            (format_code(levels + [level]), len(child.documents) if by_documents else child.count)
+            for level, child in heapq.nlargest(n, node.children.items(), key=key)
+        ]
+
+    @classmethod
+    def from_upper_dict(cls, upper_dict):
+        """ Build an index (counts only) from a ClassificationCounter upper_dict,
+        e.g. one loaded from results.pkl. Concatenated subgroup keys are split
+        after the longest matching main group."""
+        index = cls()
+        main_groups = upper_dict.get('main-group', {})
+        for tag, counts in upper_dict.items():
+            for key, count in counts.items():
+                levels = [key[:1], key[1:3], key[3:4]]
+                if tag == 'main-group':
+                    levels.append(key[4:])
+                elif tag == 'subgroup':
+                    matches = [group for group in main_groups if key.startswith(group)] or [key[:4]]
+                    main_group = max(matches, key=len)
+                    levels.extend([main_group[4:], key[len(main_group):]])
+                levels = levels[:LEVELS.index(tag) + 1]
+                node = index.root
+                for level in levels[:-1]:
+                    node = node.children.setdefault(level, IndexNode())
+                child = node.children.setdefault(levels[-1], IndexNode())
+                child.count += count
+                if tag == 'section':
+                    index.root.count += count
+        return index
+
+
+def format_code(levels):
+    """ Format levels as a code, e.g. ["G", "06", "F", "16", "30"] -> "G06F 16/30". """
+    code = "".join(levels[:3])
+    if len(levels) > 3:
+        code += " " + levels[3]
+    if len(levels) > 4:
+        code += "/" + levels[4]
+    return code
+
+
+def document_classifications(cleaned_data):
+    """ Tuple of level tuples for the classifications of a cleaned document. """
+    if isinstance(cleaned_data, dict):
+        return tuple(
+            tuple(classification[level] for level in CLEAN_DATA_LEVELS)
+            for classification in cleaned_data["classifications"]
+        )
+    return tuple(tuple(classification) for classification in cleaned_data.classifications)
+
+
+class ClassificationReport():
+    """ Pre-aggregated classification counts for a portfolio, kept up to date
+    as documents are synced so charts never re-parse or re-count documents.
+    Holds a ClassificationIndex plus the classifications last counted for
+    each document, so a changed document replaces its old contribution
+    rather than being counted twice."""
+
+    def __init__(self):
+        self.index = ClassificationIndex()
+        self.documents = {}
+        self.batches = set()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def update(self, doc_id, cleaned_data):
+        """ Count a new document or replace the counts of a changed one.
+        param cleaned_data: dictionary or PatentRecord from EPOops.clean_data;
+        clean_data error strings are ignored"""
+        if isinstance(cleaned_data, str):
+            return
+        classifications = document_classifications(cleaned_data)
+        previous = self.documents.get(doc_id)
+        if previous == classifications:
+            return
+        for levels in previous or ():
+            self.index.remove(levels, doc_id)
+        for levels in classifications:
+            self.index.add(levels, doc_id)
+        self.documents[doc_id] = classifications
+
+    def update_from_sync(self, directory):
+        """ Count the biblio records in batches written by sync.PortfolioSync
+        since the last call. Returns the number of records read."""
+        from sync import SyncCheckpoint, iter_synced
+        checkpoint = SyncCheckpoint(os.path.join(directory, "checkpoint.db"))
+        try:
+            new_batches = checkpoint.batches() - self.batches
+        finally:
+            checkpoint.close()
+        records = 0
+        for number, source, data in iter_synced(directory, "biblio", batches=new_batches):
+            self.update(number, extract_record(data))
+            records += 1
+        self.batches |= new_batches
+        return records
+
+    def chart_data(self, code=(), n=8, by_documents=False, other="Other"):
+        """ (label, value) pairs for the next level under a code or prefix:
+        the n largest, then everything else summed into one other bucket.
+        param bool by_documents: count documents instead of classifications"""
+        levels = parse_code(code)
+        node = self.index.node(levels)
+        if node is None:
+            return []
+        top = self.index.top(levels, n, by_documents)
+        shown = set(label for label, value in top)
+        rest = [
+            child for level, child in node.children.items()
+            if format_code(levels + [level]) not in shown
+        ]
+        if rest:
+            if by_documents:
+                documents = set()
+                for child in rest:
+                    documents |= child.documents
+                top.append((other, len(documents)))
+            else:
+                top.append((other, sum(child.count for child in rest)))
+        return top
+
+    def render(self, filename, code=(), n=8, by_documents=False, title=None):
+        """ Render a pie chart of chart_data to an SVG file. Requires pygal.
+        Each slice can be drilled into by rendering again with its code."""
+        import pygal
+        from pygal.style import CleanStyle
+        chart = pygal.Pie(style=CleanStyle)
+        chart.title = title or "Classifications under %s" % (format_code(parse_code(code)) or "all sections")
+        for label, value in self.chart_data(code, n, by_documents):
+            chart.add(label, value)
+        chart.render_to_file(filename)
+
+    def render_drilldown(self, directory, depth=3, n=8, by_documents=False):
+        """ Render the top level chart and one chart per shown code down to
+        depth levels (section, class, subclass), as <code>.svg files.
+        Returns the list of files written."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        written = []
+        codes = [()]
+        for level in range(depth):
+            next_codes = []
+            for code in codes:
+                name = format_code(list(code)).replace(" ", "_").replace("/", "-") or "all"
+                filename = os.path.join(directory, name + ".svg")
+                self.render(filename, code, n, by_documents)
+                written.append(filename)
+                next_codes.extend(
+                    tuple(parse_code(label)) for label, value in self.index.top(list(code), n, by_documents))
+            codes = next_codes
+        return written
+
+    def upper_dict(self):
+        """ Counts in the ClassificationCounter upper_dict layout, e.g. for results.pkl. """
+        upper_dict = {}
+
+        def walk(node, levels):
+            for level, child in node.children.items():
+                path = levels + [level]
+                counts = upper_dict.setdefault(LEVELS[len(path) - 1], {})
+                counts["".join(path)] = counts.get("".join(path), 0) + child.count
+                walk(child, path)
+
+        walk(self.index.root, [])
+        return upper_dict
+
+    def save(self, filename):
+        with open(filename + ".tmp", "wb") as f:
+            pickle.dump(self, f, 2)
+        os.rename(filename + ".tmp", filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+
+    @classmethod
+    def from_upper_dict(cls, upper_dict):
+        """ Report (counts only, no per-document tracking) from a results.pkl upper_dict. """
+        report = cls()
+        report.index = ClassificationIndex.from_upper_dict(upper_dict)
+        return report
@@ -0,0 +1,314 @@
+# Python 2.7 and 3+ Version
+
+# Columnar export of cleaned bibliographic data
+#
+# Batches of EPOops.clean_data records are written as NumPy .npy columns so
+# they can be memory-mapped and filtered with vectorised scans instead of
+# re-reading and re-cleaning JSON for every query.
+#
+# Layout of an export directory:
+#   dictionaries.json          string values for each dictionary-encoded column
+#   part-00000/                one directory per written batch, written as
+#                              tmp-part-00000/ and renamed once complete
+#     documents.<column>.npy   one row per record
+#     <table>.<column>.npy     exploded tables with a doc_row column
+#     <column>.data.npy        UTF-8 bytes of a string column
+#     <column>.offsets.npy     start offset of each string, plus the end
+
+from __future__ import print_function
+
+import glob
+import json
+import os
+import shutil
+
+import numpy as np
+
+from classifications import parse_code
+
+# Exploded tables and their columns - doc_row is the row in the part's documents table
+TABLES = {
+    "documents": ["publication", "title", "pub_date", "country", "application_date", "earliest_date"],
+    "applicants": ["doc_row", "applicant"],
+    "inventors": ["doc_row", "inventor"],
+    "classifications": ["doc_row", "code", "subclass"],
+    "priorities": ["doc_row", "number", "date", "country"],
+    "citations": ["doc_row", "number", "date", "category"]
+}
+
+# Dictionary-encoded columns hold int32 codes into these dictionaries
+DICTIONARIES = ["countries", "applicants", "inventors", "classifications", "subclasses", "categories"]
+
+# Variable length string columns stored as bytes + offsets
+STRING_COLUMNS = ["documents.publication", "documents.title", "priorities.number", "citations.number"]
+
+# Integer-encoded dates are YYYYMMDD, with 0 for a missing date
+MISSING_DATE = 0
+
+def encode_date(date_string):
+    """ "20150107" -> 20150107, missing or malformed -> 0 """
+    try:
+        return int(date_string) if date_string and len(date_string) == 8 else MISSING_DATE
+    except ValueError:
+        return MISSING_DATE
+
+def classification_code(classification):
+    """ Format a clean_data classification dict as "G06F 16/30". """
+    code = "".join(classification[level] or "" for level in ["section", "class", "subclass"])
+    if classification.get("maingroup"):
+        code += " " + classification["maingroup"]
+        if classification.get("subgroup"):
+            code += "/" + classification["subgroup"]
+    return code
+
+def code_matches(code, prefix_levels):
+    """ True if a stored code is at or below a parsed classification prefix,
+    comparing whole levels so "H01L 2" does not match "H01L 21/02". """
+    try:
+        return parse_code(code)[:len(prefix_levels)] == prefix_levels
+    except ValueError:
+        return False
+
+
+class Dictionary():
+    """ Append-only mapping between strings and integer codes. """
+
+    def __init__(self, values=None):
+        self.values = list(values or [])
+        self.codes = dict((value, code) for code, value in enumerate(self.values))
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def lookup(self, value):
+        """ Code for value, or -1 if it has never been encoded. """
+        return self.codes.get(value, -1)
+
+    def matching(self, predicate):
+        """ Array of codes whose value satisfies predicate. """
+        return np.array([code for code, value in enumerate(self.values) if predicate(value)], dtype=np.int32)
+
+
+def save_strings(path_prefix, strings):
+    """ Save a list of strings as concatenated UTF-8 bytes plus offsets. """
+    encoded = [(s or "").encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    np.save(path_prefix + ".data.npy", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    np.save(path_prefix + ".offsets.npy", offsets)
+
+
+class StringColumn():
+    """ Memory-mapped string column written by save_strings. """
+
+    def __init__(self, path_prefix):
+        self.data = np.load(path_prefix + ".data.npy", mmap_mode="r")
+        self.offsets = np.load(path_prefix + ".offsets.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        return bytes(self.data[self.offsets[row]:self.offsets[row + 1]]).decode("utf-8")
+
+    def take(self, rows):
+        return [self[row] for row in rows]
+
+
+class ColumnarWriter():
+    """ Writes batches of cleaned records to a columnar export directory.
+    Dictionaries are shared by all parts, so codes are comparable across
+    batches. They are saved before each part is renamed into place, so a
+    crash leaves at worst unused dictionary entries, never a part with
+    codes that are not saved or a half-written part."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.dictionaries = load_dictionaries(directory)
+        self.parts = len(glob.glob(os.path.join(directory, "part-*")))
+
+    def dictionary(self, name):
+        if name not in self.dictionaries:
+            self.dictionaries[name] = Dictionary()
+        return self.dictionaries[name]
+
+    def write_batch(self, records):
+        """ Write one batch of records as a new part.
+        param list records: clean_data dictionaries or PatentRecords;
+        clean_data error strings are skipped
+        Returns the number of records written."""
+        columns = dict(("%s.%s" % (table, column), []) for table, columns in TABLES.items() for column in columns)
+        rows = 0
+        for record in records:
+            if isinstance(record, str):
+                continue
+            if not isinstance(record, dict):
+                record = record.to_dict()
+            self.add_record(columns, rows, record)
+            rows += 1
+        if not rows:
+            return 0
+
+        save_dictionaries(self.directory, self.dictionaries)
+        part = os.path.join(self.directory, "part-%05d" % self.parts)
+        temp = os.path.join(self.directory, "tmp-part-%05d" % self.parts)
+        if os.path.isdir(temp):
+            # Left by a crashed writer
+            shutil.rmtree(temp)
+        os.makedirs(temp)
+        for name, values in columns.items():
+            path = os.path.join(temp, name)
+            if name in STRING_COLUMNS:
+                save_strings(path, values)
+            else:
+                # Row numbers, dictionary codes and YYYYMMDD dates all fit in int32
+                np.save(path + ".npy", np.array(values, dtype=np.int32))
+        os.rename(temp, part)
+        self.parts += 1
+        return rows
+
+    def add_record(self, columns, row, record):
+        publication = record["publication"][0] if record["publication"] else {"number": "", "date": None}
+        number = publication["number"] or ""
+        application_dates = [encode_date(appln["date"]) for appln in record["application"]]
+        priority_dates = [encode_date(priority["date"]) for priority in record["priorityclaims"]]
+        known_dates = [date for date in application_dates + priority_dates if date != MISSING_DATE]
+
+        columns["documents.publication"].append(number)
+        columns["documents.title"].append(record.get("title"))
+        columns["documents.pub_date"].append(encode_date(publication["date"]))
+        columns["documents.country"].append(self.dictionary("countries").encode(number[:2]))
+        columns["documents.application_date"].append(application_dates[0] if application_dates else MISSING_DATE)
+        columns["documents.earliest_date"].append(min(known_dates) if known_dates else MISSING_DATE)
+
+        for applicant in record["applicants"]:
+            columns["applicants.doc_row"].append(row)
+            columns["applicants.applicant"].append(self.dictionary("applicants").encode(applicant))
+        for inventor in record["inventors"]:
+            columns["inventors.doc_row"].append(row)
+            columns["inventors.inventor"].append(self.dictionary("inventors").encode(inventor))
+        for classification in record["classifications"]:
+            code = classification_code(classification)
+            columns["classifications.doc_row"].append(row)
+            columns["classifications.code"].append(self.dictionary("classifications").encode(code))
+            columns["classifications.subclass"].append(self.dictionary("subclasses").encode(code[:4]))
+        for priority, date in zip(record["priorityclaims"], priority_dates):
+            columns["priorities.doc_row"].append(row)
+            columns["priorities.number"].append(priority["number"])
+            columns["priorities.date"].append(date)
+            columns["priorities.country"].append(self.dictionary("countries").encode((priority["number"] or "")[:2]))
+        for citation in record["citations"]:
+            columns["citations.doc_row"].append(row)
+            columns["citations.number"].append(citation["number"])
+            columns["citations.date"].append(encode_date(citation.get("date")))
+            columns["citations.category"].append(self.dictionary("categories").encode(citation.get("category") or ""))
+
+
+def load_dictionaries(directory):
+    path = os.path.join(directory, "dictionaries.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return dict((name, Dictionary(values)) for name, values in json.load(f).items())
+
+def save_dictionaries(directory, dictionaries):
+    path = os.path.join(directory, "dictionaries.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(dict((name, dictionary.values) for name, dictionary in dictionaries.items()), f)
+    os.rename(path + ".tmp", path)
+
+
+class ColumnarPart():
+    """ Memory-mapped columns of one written batch. """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = len(self.strings("documents.publication"))
+
+    def column(self, table, column):
+        return np.load(os.path.join(self.path, "%s.%s.npy" % (table, column)), mmap_mode="r")
+
+    def strings(self, name):
+        return StringColumn(os.path.join(self.path, name))
+
+
+class ColumnarReader():
+    """ Reads an export directory with every column memory-mapped.
+    select() filters records with vectorised comparisons on the integer and
+    dictionary-encoded columns, part by part, so only matching rows are
+    ever decoded into Python objects."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.dictionaries = load_dictionaries(directory)
+        self.parts = [ColumnarPart(path) for path in sorted(glob.glob(os.path.join(directory, "part-*")))]
+
+    def __len__(self):
+        return sum(part.rows for part in self.parts)
+
+    def dictionary(self, name):
+        return self.dictionaries.get(name) or Dictionary()
+
+    def column(self, table, column):
+        """ A whole column across all parts. doc_row values are offset to
+        global record rows. Copies the data unless there is only one part."""
+        arrays = []
+        offset = 0
+        for part in self.parts:
+            array = part.column(table, column)
+            arrays.append(array + offset if column == "doc_row" else array)
+            offset += part.rows
+        if len(arrays) == 1:
+            return arrays[0]
+        return np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int32)
+
+    def part_mask(self, part, date_from=None, date_to=None, date_column="pub_date",
+                  classification=None, applicant=None, country=None):
+        """ Boolean mask over the documents of one part matching every given filter. """
+        mask = np.ones(part.rows, dtype=bool)
+        if date_from is not None or date_to is not None:
+            dates = part.column("documents", date_column)
+            if date_from is not None:
+                mask &= dates >= encode_date(date_from)
+            if date_to is not None:
+                mask &= (dates <= encode_date(date_to)) & (dates != MISSING_DATE)
+        if country is not None:
+            mask &= part.column("documents", "country") == self.dictionary("countries").lookup(country)
+        if classification is not None:
+            prefix_levels = parse_code(classification)
+            codes = self.dictionary("classifications").matching(lambda code: code_matches(code, prefix_levels))
+            mask &= self.rows_with(part, "classifications", "code", codes)
+        if applicant is not None:
+            codes = self.dictionary("applicants").matching(lambda name: applicant.upper() in name.upper())
+            mask &= self.rows_with(part, "applicants", "applicant", codes)
+        return mask
+
+    def rows_with(self, part, table, column, codes):
+        """ Mask of documents with at least one row in an exploded table whose column is in codes. """
+        found = np.zeros(part.rows, dtype=bool)
+        if len(codes):
+            hits = np.isin(part.column(table, column), codes)
+            found[part.column(table, "doc_row")[hits]] = True
+        return found
+
+    def select(self, **filters):
+        """ Publication numbers of the records matching all filters.
+        Filters: date_from / date_to ("YYYYMMDD", applied to date_column,
+        default "pub_date"), classification (code prefix such as "G06F 16",
+        matched whole levels at a time),
+        applicant (case-insensitive substring) and country (e.g. "EP")."""
+        numbers = []
+        for part in self.parts:
+            rows = np.nonzero(self.part_mask(part, **filters))[0]
+            numbers.extend(part.strings("documents.publication").take(rows))
+        return numbers
+
+    def count(self, **filters):
+        """ Number of records matching all filters - see select. """
+        return int(sum(self.part_mask(part, **filters).sum() for part in self.parts))
@@ -9,13 +9,75 @@ except ImportError:
     import ConfigParser as configparser
 import urllib
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import base64
+import json
+import re
+import sys
+import random
+import threading
+import time
+from collections import namedtuple
+from contextlib import closing
 from datetime import datetime
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import os
 
+# Split out of this module - names are re-exported for existing imports
+from cache import CACHE_DEFAULTS, ResponseCache, cache_category
+from metrics import LATENCY_BUCKETS, Histogram, RequestEvent, RequestHooks, RequestMetrics, ops_service, url_template
+from normaliser import (
+    NUMBERS_DEFAULTS, LRUCache, NumberMapping, NumberNormaliser, local_application_epodoc, number_service_url
+)
+
+try:
+    # For Python 3>
+    intern = sys.intern
+except AttributeError:
+    # If Python < 3 intern is a builtin
+    pass
+
 # Definitions
 HOST = "ops.epo.org"
 AUTH_URL = "https://ops.epo.org/3.1/auth/accesstoken"
+BASE_URL = "https://ops.epo.org"
+
+# Maximum number of numbers OPS accepts in a single bulk POST
+BULK_BATCH_SIZE = 100
+
+# Epodoc number followed by a kind code, e.g. EP1000000A1
+KIND_CODE_RE = re.compile(r"^([A-Z]{2}[0-9]+)[A-Z][0-9]?$")
+
+# Refresh access tokens this many seconds before OPS expires them
+TOKEN_REFRESH_MARGIN = 60
+
+# Token lifetime assumed if OPS does not send expires_in - OPS tokens last 20 minutes
+TOKEN_DEFAULT_LIFETIME = 20 * 60
+
+# X-Throttling-Control: busy (images=green:100, inpadoc=yellow:45, ...)
+THROTTLING_RE = re.compile(r"^\s*(\w+)\s*\((.*)\)")
+SERVICE_RE = re.compile(r"(\w+)=(\w+):(\d+)")
+
+# Throttling defaults - override in the [Throttling] section of config.ini
+THROTTLING_DEFAULTS = {
+    "MAX_ATTEMPTS": 5,
+    "BACKOFF_BASE": 1.0,
+    "BACKOFF_MAX": 60.0,
+    "SAFETY_FACTOR": 0.9,
+    "BLACK_PAUSE": 60.0
+}
+
+# Connection defaults - override in the [Connection] section of config.ini
+CONNECTION_DEFAULTS = {
+    "POOL_CONNECTIONS": 1,
+    "POOL_MAXSIZE": 10,
+    "MAX_RETRIES": 3,
+    "BACKOFF_FACTOR": 0.5,
+    "CONNECT_TIMEOUT": 5.0,
+    "READ_TIMEOUT": 30.0
+}
 
 def check_list(listvar):
     if not isinstance(listvar, list):
@@ -41,31 +103,841 @@ def keysearch(d, key):
     if isinstance(d, dict):
         if key in d:
             return d[key]
-        else:
-            if isinstance(d, dict):
-                for k in d:
-                    found = keysearch(d[k], key)
-                    if found:
-                        return found
-            else:
-                if isinstance(d, list):
-                    for i in d:
-                        found = keysearch(d[k], key)
-                        if found:
-                            return found
+        for k in d:
+            found = keysearch(d[k], key)
+            if found:
+                return found
+    elif isinstance(d, list):
+        for i in d:
+            found = keysearch(i, key)
+            if found:
+                return found
+
+def local_name(tag):
+    """ Strip the namespace from an ElementTree tag, e.g. "{http://www.epo.org/fulltext}p" -> "p". """
+    return tag.rsplit("}", 1)[-1]
+
+def iter_element_text(source, tag, within=None, lang=None):
+    """ Generator incrementally parsing XML and yielding the text of each
+    outermost element named tag, optionally only inside an element named
+    within whose lang attribute matches lang. Parsed elements are detached
+    as soon as they close so memory use does not grow with the document.
+    param file source: file-like object, e.g. a streamed response body
+    param string tag: local name of the elements to yield, e.g. "claim-text"
+    param string within: local name of a required ancestor, e.g. "description"
+    param string lang: language code required on the ancestor, e.g. "EN" """
+    stack = []
+    for event, elem in ElementTree.iterparse(source, events=("start", "end")):
+        if event == "start":
+            stack.append(elem)
+            continue
+        stack.pop()
+        name = local_name(elem.tag)
+        inside_tag = any(local_name(parent.tag) == tag for parent in stack)
+        if name == tag and not inside_tag:
+            if within is None or any(
+                    local_name(parent.tag) == within and (lang is None or parent.get("lang", "").upper() == lang.upper())
+                    for parent in stack):
+                yield "".join(elem.itertext()).strip()
+        if stack and not inside_tag:
+            stack[-1].remove(elem)
+
+def get_setting(parser, section, option, default):
+    """ Read an optional setting from config.ini, falling back to a default.
+    The returned value is cast to the type of the default.
+    param ConfigParser parser: parser holding config.ini
+    param string section: section name
+    param string option: option name
+    param default: value used if the section or option is missing"""
+    if not parser.has_option(section, option):
+        return default
+    return type(default)(parser.get(section, option))
+
+def load_config(config_file=None):
+    """ Read config.ini - defaults to the one alongside this file. """
+    parser = configparser.ConfigParser()
+    parser.read(config_file or (os.path.abspath(os.path.dirname(__file__)) + '/config.ini'))
+    return parser
+
+def build_session(pool_connections, pool_maxsize, max_retries, backoff_factor):
+    """ Build a requests Session with a pooled, retrying HTTPS adapter.
+    param int pool_connections: number of host pools to cache
+    param int pool_maxsize: maximum connections kept alive per host
+    param int max_retries: retries on connection errors and 5xx gateway errors
+    param float backoff_factor: exponential backoff between retries"""
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(500, 502, 504),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Connection": "Keep-Alive"})
+    return session
+
+def run_many(func, items, max_workers):
+    """ Generator applying func to each item on a thread pool.
+    Yields (item, result) tuples in completion order. An exception raised
+    for an item is yielded as its result rather than being raised.
+    At most 2 * max_workers calls are in flight at any one time so that
+    long input lists do not all sit in the executor queue.
+    param function func: function taking a single item
+    param iterable items: items to process
+    param int max_workers: number of worker threads"""
+    items = iter(items)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = {}
+    
+    def submit_next():
+        for item in items:
+            pending[executor.submit(func, item)] = item
+            return True
+        return False
+    
+    try:
+        while len(pending) < 2 * max_workers and submit_next():
+            pass
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as error:
+                    result = error
+                submit_next()
+                yield item, result
+    finally:
+        # Drop queued work if the caller stops iterating early
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def chunked(items, size):
+    """ Generator splitting an iterable into lists of at most size items. """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def epodoc_key(number):
+    """ Normalise an epodoc number for matching, e.g. "ep1000000.A1" -> "EP1000000A1". """
+    return number.strip().replace(".", "").upper()
+
+def match_documents(groups, number):
+    """ Look up the documents grouped under an epodoc number.
+    Falls back to ignoring a trailing kind code on the requested number.
+    param dict groups: epodoc key -> list of documents
+    param string number: requested epodoc number"""
+    key = epodoc_key(number)
+    if key in groups:
+        return groups[key]
+    match = KIND_CODE_RE.match(key)
+    if match:
+        return groups.get(match.group(1), [])
+    return []
+
+def exchange_document_keys(exdoc, number_type):
+    """ Epodoc numbers under which a bulk exchange-document can be matched.
+    param dict exdoc: exchange-document from a published-data response
+    param string number_type: "publication", "application" or "priority" """
+    biblio = exdoc.get("bibliographic-data", {})
+    if number_type == "application":
+        records = check_list(safeget(biblio, "application-reference", "document-id"))
+    elif number_type == "priority":
+        records = []
+        for priority in check_list(safeget(biblio, "priority-claims", "priority-claim")):
+            if priority:
+                records.extend(check_list(priority.get("document-id")))
+    else:
+        records = check_list(safeget(biblio, "publication-reference", "document-id"))
+    keys = set(
+        epodoc_key(safeget(record, "doc-number", "$"))
+        for record in records
+        if record and record.get("@document-id-type") == "epodoc" and safeget(record, "doc-number", "$")
+    )
+    if number_type == "publication" and "@doc-number" in exdoc:
+        keys.add(epodoc_key(exdoc.get("@country", "") + exdoc["@doc-number"]))
+        keys.add(epodoc_key(exdoc.get("@country", "") + exdoc["@doc-number"] + exdoc.get("@kind", "")))
+    return keys
+
+def split_exchange_documents(response, numbers, number_type="publication"):
+    """ Split a bulk published-data response into single-number responses.
+    Each number gets a response shaped like the one get_data returns for
+    that number alone, so it can be passed straight to clean_data.
+    Numbers with no matching document get a "not found" exchange-document.
+    param dict response: parsed JSON from a bulk request
+    param list numbers: numbers sent in the bulk request"""
+    groups = {}
+    for exdoc in check_list(safeget(response, "ops:world-patent-data", "exchange-documents", "exchange-document")):
+        if exdoc:
+            for key in exchange_document_keys(exdoc, number_type):
+                groups.setdefault(key, []).append(exdoc)
+    for number in numbers:
+        documents = match_documents(groups, number)
+        if not documents:
+            documents = [{"@status": "not found"}]
+        yield number, {
+            "ops:world-patent-data": {
+                "exchange-documents": {
+                    "exchange-document": documents[0] if len(documents) == 1 else documents
+                }
+            }
+        }
+
+def register_document_keys(regdoc, number_type):
+    """ Epodoc numbers under which a bulk register-document can be matched. """
+    biblio = regdoc.get("reg:bibliographic-data", {})
+    if number_type == "application":
+        references = check_list(biblio.get("reg:application-reference"))
+    else:
+        references = check_list(biblio.get("reg:publication-reference"))
+    keys = set()
+    for reference in references:
+        for record in check_list(safeget(reference or {}, "reg:document-id")):
+            if record:
+                keys.add(epodoc_key(
+                    (safeget(record, "reg:country", "$") or "") + (safeget(record, "reg:doc-number", "$") or "")))
+    return keys
+
+def split_register_documents(response, numbers, number_type="publication"):
+    """ Split a bulk register response into (status_code, response) per number,
+    matching the return value of EPOops.get_register. """
+    groups = {}
+    documents = safeget(response, "ops:world-patent-data", "ops:register-search", "reg:register-documents", "reg:register-document")
+    for regdoc in check_list(documents):
+        if regdoc:
+            for key in register_document_keys(regdoc, number_type):
+                groups.setdefault(key, []).append(regdoc)
+    for number in numbers:
+        matches = match_documents(groups, number)
+        if not matches:
+            yield number, (404, "Document not found in bulk register response")
+            continue
+        yield number, (200, {
+            "ops:world-patent-data": {
+                "ops:register-search": {
+                    "reg:register-documents": {
+                        "reg:register-document": matches[0] if len(matches) == 1 else matches
+                    }
+                }
+            }
+        })
+
+def reference_numbers(references):
+    """ Epodoc-style numbers (country + doc number, no kind code) from
+    publication-reference records in search and equivalents responses. """
+    numbers = []
+    for reference in check_list(references):
+        for record in check_list(safeget(reference or {}, "document-id")):
+            if not record:
+                continue
+            country = safeget(record, "country", "$") or ""
+            number = safeget(record, "doc-number", "$")
+            if number:
+                numbers.append(country + number)
+    return numbers
+
+def parse_throttling_control(header):
+    """ Parse an X-Throttling-Control header.
+    Returns (system_state, {service: (colour, requests_per_minute)}) or (None, {})."""
+    match = THROTTLING_RE.match(header or "")
+    if not match:
+        return None, {}
+    services = dict(
+        (service, (colour, int(rate)))
+        for service, colour, rate in SERVICE_RE.findall(match.group(2))
+    )
+    return match.group(1), services
+
+
+class ThrottleController():
+    """ Adaptive per-service rate limiter driven by OPS response headers.
+    Each response updates the allowed requests per minute for its service;
+    acquire() then spaces requests for that service to stay just under it.
+    Safe to share between threads."""
+    
+    def __init__(self, safety_factor=0.9, backoff_base=1.0, backoff_max=60.0, black_pause=60.0):
+        self.safety_factor = safety_factor
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.black_pause = black_pause
+        self.lock = threading.Lock()
+        self.system_state = None
+        self.services = {}
+        self.next_slot = {}
+        self.quota = {}
+    
+    def interval(self, service):
+        """ Minimum seconds between requests to a service, or 0 if unknown. """
+        colour, rate = self.services.get(service, (None, 0))
+        if not rate:
+            return 0
+        return 60.0 / (rate * self.safety_factor)
+    
+    def reserve(self, service):
+        """ Claim the next request slot for service and return the seconds until it. """
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot.get(service, now))
+            self.next_slot[service] = slot + self.interval(service)
+        return slot - now
+    
+    def acquire(self, service):
+        """ Block until a request to service may be sent. """
+        delay = self.reserve(service)
+        if delay > 0:
+            time.sleep(delay)
+    
+    def update(self, service, headers):
+        """ Record throttling and quota headers from a response. """
+        state, services = parse_throttling_control(headers.get("X-Throttling-Control"))
+        with self.lock:
+            if state:
+                self.system_state = state
+                self.services.update(services)
+                colour, rate = services.get(service, (None, 0))
+                if colour == "black":
+                    self.pause(service, self.black_pause)
+            for name, value in headers.items():
+                # e.g. X-IndividualQuotaPerHour-Used, X-RegisteredQuotaPerWeek-Used
+                if "quota" in name.lower() and name.lower().endswith("-used"):
+                    try:
+                        self.quota[name] = int(value)
+                    except ValueError:
+                        pass
+    
+    def pause(self, service, delay):
+        """ Hold back all requests to service for delay seconds. Caller holds the lock. """
+        self.next_slot[service] = max(self.next_slot.get(service, 0), time.time() + delay)
+    
+    def defer(self, service, attempt, retry_after=None):
+        """ Hold back a service after a rejected request, using exponential backoff
+        with full jitter unless the server sent a Retry-After delay. The next
+        acquire or reserve for the service - from any thread - waits it out."""
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        with self.lock:
+            self.pause(service, delay)
+    
+    def usage(self):
+        """ Snapshot of the latest system state, per-service limits and quota counters. """
+        with self.lock:
+            return {
+                "system_state": self.system_state,
+                "services": dict(self.services),
+                "quota": dict(self.quota)
+            }
+
+
+# Shared objects for values that repeat across many records
+DATE_CACHE = {}
+CLASSIFICATION_CACHE = {}
+
+def parse_date(date_string):
+    """ Parse an OPS YYYYMMDD date once, returning a shared datetime or None. """
+    if not date_string:
+        return None
+    try:
+        return DATE_CACHE[date_string]
+    except KeyError:
+        try:
+            parsed = datetime.strptime(date_string, "%Y%m%d")
+        except ValueError:
+            parsed = None
+        DATE_CACHE[date_string] = parsed
+        return parsed
+
+def format_date(date):
+    """ Inverse of parse_date. """
+    return date.strftime("%Y%m%d") if date else None
+
+def intern_string(value):
+    """ Intern a string so repeated values share one object. """
+    return intern(value) if isinstance(value, str) else value
+
+
+class DocumentRef(namedtuple("DocumentRef", ["number", "date"])):
+    """ Publication, application or priority number with a parsed date. """
+    __slots__ = ()
+    
+    @property
+    def country(self):
+        return self.number[:2] if self.number else None
+    
+    def to_dict(self):
+        return {"number": self.number, "date": format_date(self.date)}
+
+
+class Citation(namedtuple("Citation", ["number", "date", "category"])):
+    """ Cited patent document with optional date and search report category. """
+    __slots__ = ()
+    
+    def to_dict(self):
+        cleaned_citation = {"number": self.number}
+        if self.date is not None:
+            cleaned_citation["date"] = format_date(self.date)
+        if self.category is not None:
+            cleaned_citation["category"] = self.category
+        return cleaned_citation
+
+
+class Classification(namedtuple("Classification", ["section", "class_", "subclass", "maingroup", "subgroup"])):
+    """ CPC/IPC classification split into its levels. """
+    __slots__ = ()
+    
+    @classmethod
+    def get(cls, section, class_, subclass, maingroup, subgroup):
+        """ Return a shared, interned Classification for the given levels. """
+        key = (section, class_, subclass, maingroup, subgroup)
+        try:
+            return CLASSIFICATION_CACHE[key]
+        except KeyError:
+            classification = cls(*[intern_string(level) for level in key])
+            CLASSIFICATION_CACHE[key] = classification
+            return classification
+    
+    def to_dict(self):
+        return {
+            "section": self.section,
+            "class": self.class_,
+            "subclass": self.subclass,
+            "maingroup": self.maingroup,
+            "subgroup": self.subgroup
+        }
+
+
+class PatentRecord(object):
+    """ Compact form of the dictionary returned by EPOops.clean_data.
+    Lists are stored as tuples, dates are parsed once and classification
+    codes and party names are interned so they are shared between records."""
+    
+    __slots__ = ("title", "publication", "applicants", "inventors", "application",
+                 "priorityclaims", "classifications", "abstract", "citations")
+    
+    def __init__(self, title=None, publication=(), applicants=(), inventors=(), application=(),
+                 priorityclaims=(), classifications=(), abstract=None, citations=()):
+        self.title = title
+        self.publication = tuple(publication)
+        self.applicants = tuple(applicants)
+        self.inventors = tuple(inventors)
+        self.application = tuple(application)
+        self.priorityclaims = tuple(priorityclaims)
+        self.classifications = tuple(classifications)
+        self.abstract = abstract
+        self.citations = tuple(citations)
+    
+    @classmethod
+    def from_dict(cls, cleaned_data):
+        """ Build a record from the dictionary returned by clean_data. """
+        def refs(records):
+            return [DocumentRef(record["number"], parse_date(record["date"])) for record in records]
+        return cls(
+            title=cleaned_data["title"],
+            publication=refs(cleaned_data["publication"]),
+            applicants=[intern_string(applicant) for applicant in cleaned_data["applicants"]],
+            inventors=[intern_string(inventor) for inventor in cleaned_data["inventors"]],
+            application=refs(cleaned_data["application"]),
+            priorityclaims=refs(cleaned_data["priorityclaims"]),
+            classifications=[
+                Classification.get(c["section"], c["class"], c["subclass"], c["maingroup"], c["subgroup"])
+                for c in cleaned_data["classifications"]
+            ],
+            abstract=cleaned_data["abstract"],
+            citations=[
+                Citation(c["number"], parse_date(c.get("date")), intern_string(c.get("category")))
+                for c in cleaned_data["citations"]
+            ]
+        )
+    
+    def to_dict(self):
+        """ Convert back to the dictionary shape returned by clean_data. """
+        return {
+            "title": self.title,
+            "publication": [ref.to_dict() for ref in self.publication],
+            "applicants": list(self.applicants),
+            "inventors": list(self.inventors),
+            "application": [ref.to_dict() for ref in self.application],
+            "priorityclaims": [ref.to_dict() for ref in self.priorityclaims],
+            "classifications": [c.to_dict() for c in self.classifications],
+            "abstract": self.abstract,
+            "citations": [c.to_dict() for c in self.citations]
+        }
+    
+    def __repr__(self):
+        numbers = [ref.number for ref in self.publication]
+        return "PatentRecord(%s, %r)" % (", ".join(numbers), self.title)
+
+
+def compile_path(*keys):
+    """ Compile a key path into a function returning every value found at the
+    end of the path. Lists met along the way are expanded, so a path through
+    single-or-list OPS elements needs no check_list calls.
+    param string keys: one or more keys"""
+    def extract(node):
+        nodes = node if isinstance(node, list) else [node]
+        for key in keys:
+            found = []
+            for item in nodes:
+                if isinstance(item, dict) and key in item:
+                    value = item[key]
+                    if isinstance(value, list):
+                        found.extend(value)
+                    else:
+                        found.append(value)
+            if not found:
+                return found
+            nodes = found
+        return nodes
+    return extract
+
+def compile_value(*keys):
+    """ Compile a key path into a function returning the first value found or None.
+    Plain nested dicts are indexed directly; lists fall back to compile_path."""
+    extract = compile_path(*keys)
+    def first(node):
+        value = node
+        try:
+            for key in keys:
+                value = value[key]
+            return value
+        except KeyError:
+            return None
+        except TypeError:
+            values = extract(node)
+            return values[0] if values else None
+    return first
+
+
+# Declarative description of the fields clean_data extracts from an
+# exchange-document. Every item found at path is kept if
+# item[where[0]] == where[1] and then passed to build; first fields keep
+# only the first result.
+ExtractionField = namedtuple("ExtractionField", ["name", "path", "where", "build", "first"])
+
+doc_number = compile_value("doc-number", "$")
+doc_date = compile_value("date", "$")
+text_value = compile_value("$")
+applicant_name = compile_value("applicant-name", "name", "$")
+inventor_name = compile_value("inventor-name", "name", "$")
+section_value = compile_value("section", "$")
+class_value = compile_value("class", "$")
+subclass_value = compile_value("subclass", "$")
+maingroup_value = compile_value("main-group", "$")
+subgroup_value = compile_value("subgroup", "$")
+
+def build_reference(record):
+    return {"number": doc_number(record), "date": doc_date(record)}
+
+def build_classification(record):
+    return {
+        "section": section_value(record),
+        "class": class_value(record),
+        "subclass": subclass_value(record),
+        "maingroup": maingroup_value(record),
+        "subgroup": subgroup_value(record)
+    }
+
+EXCHANGE_DOCUMENT_FIELDS = [
+    ExtractionField("title", ("bibliographic-data", "invention-title"), ("@lang", "en"), text_value, True),
+    ExtractionField("publication", ("bibliographic-data", "publication-reference", "document-id"),
+                    ("@document-id-type", "epodoc"), build_reference, False),
+    ExtractionField("applicants", ("bibliographic-data", "parties", "applicants", "applicant"),
+                    ("@data-format", "epodoc"), applicant_name, False),
+    ExtractionField("inventors", ("bibliographic-data", "parties", "inventors", "inventor"),
+                    ("@data-format", "epodoc"), inventor_name, False),
+    ExtractionField("application", ("bibliographic-data", "application-reference", "document-id"),
+                    ("@document-id-type", "epodoc"), build_reference, False),
+    ExtractionField("priorityclaims", ("bibliographic-data", "priority-claims", "priority-claim", "document-id"),
+                    ("@document-id-type", "epodoc"), build_reference, False),
+    ExtractionField("classifications", ("bibliographic-data", "patent-classifications", "patent-classification"),
+                    None, build_classification, False),
+    ExtractionField("abstract", ("abstract", "p", "$"), None, None, True)
+]
+
+
+class RecordExtractor():
+    """ Precompiled extractor filling every field from an exchange-document in
+    a single walk. Field paths are merged into a tree of keys, and each tree
+    node is compiled into a closure, so a shared prefix such as
+    "bibliographic-data" / "parties" is descended only once rather than once
+    per field as with repeated safeget calls."""
+    
+    def __init__(self, fields):
+        self.fields = fields
+        tree = ({}, [])
+        for field in fields:
+            children, terminal = tree
+            for key in field.path:
+                children, terminal = children.setdefault(key, ({}, []))
+            terminal.append(field)
+        self.visit = self.compile_node(tree)
+    
+    def compile_node(self, tree):
+        """ Compile a tree node into visit(node, record), where node is the
+        value found at the node's path - a single item or a list of items. """
+        children, terminal = tree
+        fills = [self.compile_field(field) for field in terminal]
+        compiled_children = [(key, self.compile_node(subtree)) for key, subtree in children.items()]
+        
+        def visit(node, record):
+            items = node if isinstance(node, list) else (node,)
+            for fill in fills:
+                fill(items, record)
+            if compiled_children:
+                for item in items:
+                    if isinstance(item, dict):
+                        for key, visit_child in compiled_children:
+                            if key in item:
+                                visit_child(item[key], record)
+        return visit
+    
+    def compile_field(self, field):
+        """ Compile a field into fill(items, record) adding the kept items to the record. """
+        name = field.name
+        build = field.build or (lambda item: item)
+        where_key, where_value = field.where or (None, None)
+        first = field.first
+        
+        def fill(items, record):
+            for item in items:
+                if where_key is not None and (not isinstance(item, dict) or item.get(where_key) != where_value):
+                    continue
+                if first:
+                    if record[name] is None:
+                        record[name] = build(item)
+                    return
+                record[name].append(build(item))
+        return fill
+    
+    def extract(self, exdoc):
+        """ Return a dictionary of field name -> value for one exchange-document. """
+        record = dict((field.name, None if field.first else []) for field in self.fields)
+        self.visit(exdoc, record)
+        return record
+
+
+citation_list = compile_value("bibliographic-data", "references-cited", "citation")
+citation_records = compile_value("patcit", "document-id")
+citation_category = compile_value("category", "$")
+
+def extract_citations(documents):
+    """ Epodoc patent citations from all exchange-documents, de-duplicated by number.
+    param list documents: exchange-documents, e.g. the A1 and B1 publications"""
+    citations = []
+    seen = set()
+    for document in check_list(documents):
+        for citation in check_list(citation_list(document)):
+            if not isinstance(citation, dict):
+                continue
+            for c_record in check_list(citation_records(citation)):
+                if not c_record or c_record.get("@document-id-type") != "epodoc":
+                    continue
+                number = doc_number(c_record)
+                if number in seen:
+                    continue
+                seen.add(number)
+                cleaned_citation = {"number": number}
+                if "date" in c_record:
+                    cleaned_citation["date"] = doc_date(c_record)
+                if "category" in citation:
+                    cleaned_citation["category"] = citation_category(citation)
+                citations.append(cleaned_citation)
+    return citations
+
+EXCHANGE_DOCUMENT_EXTRACTOR = RecordExtractor(EXCHANGE_DOCUMENT_FIELDS)
+
+def extract_record(data, compact=False):
+    """ Flatten a published-data biblio response into the dictionary returned
+    by EPOops.clean_data, or a PatentRecord if compact is set. """
+    # Check data relates to located document
+    data_to_check = safeget(data, "ops:world-patent-data", "exchange-documents", "exchange-document")
+    if isinstance(data_to_check, dict):
+        if data_to_check.get("@status") == "not found":
+            return "Error: document not found"
+        exdoc = data_to_check
+    elif isinstance(data_to_check, list) and (len(data_to_check) > 0):
+        exdoc = data_to_check[0]
+    else:
+        return "Error: document not found"
+    
+    cleaned_data = EXCHANGE_DOCUMENT_EXTRACTOR.extract(exdoc)
+    cleaned_data["citations"] = extract_citations(data_to_check)
+    if compact:
+        return PatentRecord.from_dict(cleaned_data)
+    return cleaned_data
 
 
-class EPOops():
+class EPOopsBase(RequestHooks):
+    """ Configuration, access token, retry and response cache handling shared
+    by EPOops and async_epo_ops.AsyncEPOops. Subclasses do the I/O. """
     
-    def __init__(self):
-        #Load Settings
-        parser = configparser.SafeConfigParser()
-        parser.read(os.path.abspath(os.path.dirname(__file__)) + '/config.ini')
+    def configure(self, config_file=None):
+        """ Load config.ini settings common to both clients and return the
+        [Connection] settings for the subclass to build its session from. """
+        parser = load_config(config_file)
         self.consumer_key = parser.get('Login Parameters', 'C_KEY')
         self.consumer_secret = parser.get('Login Parameters', 'C_SECRET')
-        self.host = HOST
-        self.auth_url = AUTH_URL
-        self.authorise()
+        # URLs can be pointed at a local stand-in server, e.g. for benchmarks
+        self.host = get_setting(parser, 'URLs', 'HOST', HOST)
+        self.auth_url = get_setting(parser, 'URLs', 'AUTH_URL', AUTH_URL)
+        self.base_url = get_setting(parser, 'URLs', 'BASE_URL', BASE_URL)
+        
+        settings = dict(
+            (option, get_setting(parser, 'Connection', option, default))
+            for option, default in CONNECTION_DEFAULTS.items()
+        )
+        self.pool_maxsize = settings["POOL_MAXSIZE"]
+        
+        # Adaptive rate limiting from OPS throttling headers
+        throttling = dict(
+            (option, get_setting(parser, 'Throttling', option, default))
+            for option, default in THROTTLING_DEFAULTS.items()
+        )
+        self.max_attempts = throttling["MAX_ATTEMPTS"]
+        self.throttle = ThrottleController(
+            safety_factor=throttling["SAFETY_FACTOR"],
+            backoff_base=throttling["BACKOFF_BASE"],
+            backoff_max=throttling["BACKOFF_MAX"],
+            black_pause=throttling["BLACK_PAUSE"]
+        )
+        
+        # Optional persistent response cache
+        cache_settings = dict(
+            (option, get_setting(parser, 'Cache', option, default))
+            for option, default in CACHE_DEFAULTS.items()
+        )
+        self.cache = None
+        if cache_settings["PATH"]:
+            ttls = dict(
+                (option[len("TTL_"):].lower(), value)
+                for option, value in cache_settings.items() if option.startswith("TTL_")
+            )
+            self.cache = ResponseCache(cache_settings["PATH"], cache_settings["MAX_BYTES"], ttls)
+        
+        # Memoised number conversion, optionally persisted between runs
+        self.numbers = NumberNormaliser(
+            self,
+            get_setting(parser, 'Numbers', 'MAPPING_PATH', NUMBERS_DEFAULTS["MAPPING_PATH"]),
+            get_setting(parser, 'Numbers', 'LRU_SIZE', NUMBERS_DEFAULTS["LRU_SIZE"])
+        )
+        
+        # Callbacks receiving a RequestEvent after each request
+        self.hooks = []
+        
+        # Access token is fetched lazily on the first request and shared by all requests
+        self.access_token = None
+        self.token_expiry = 0
+        return settings
+    
+    def close_stores(self):
+        """ Close the number mapping table and the response cache. """
+        self.numbers.close()
+        if self.cache is not None:
+            self.cache.close()
+    
+    def quota_usage(self):
+        """ Current OPS system state, per-service traffic lights and quota usage. """
+        return self.throttle.usage()
+    
+    def accept_token(self, token):
+        """ Store the access token from a parsed authorisation reply. """
+        self.access_token = token['access_token']
+        self.token_expiry = time.time() + int(token.get('expires_in') or TOKEN_DEFAULT_LIFETIME)
+    
+    def token_valid(self):
+        return bool(self.access_token) and time.time() < self.token_expiry - TOKEN_REFRESH_MARGIN
+    
+    def start_stats(self, url_portion, stats):
+        """ Reset the per-request stats fetch fills in and return the OPS service. """
+        service = ops_service(url_portion)
+        stats.setdefault("started", time.time())
+        stats.update(service=service, attempts=0, token_refreshes=0, wait=0.0, ttfb=0.0, download=0.0)
+        return service
+    
+    def retry_action(self, status_code, headers, reauthorised, attempt):
+        """ What fetch does with a response: "refresh" the access token and
+        resend (once, on 400), "backoff" and resend if OPS rejected the request
+        as overloaded, or None to return it. """
+        if status_code == 400 and not reauthorised:
+            return "refresh"
+        if status_code in (403, 429, 503) and attempt + 1 < self.max_attempts:
+            # Exhausted quotas will not recover by retrying
+            if "Quota" not in headers.get("X-Rejection-Reason", ""):
+                return "backoff"
+        return None
+    
+    def cache_lookup(self, url_portion, params=None, data=None):
+        """ Returns (cache_key, cached entry or None, revalidation headers). """
+        if self.cache is None:
+            return None, None, {}
+        cache_key = self.cache.make_key(url_portion, params, data)
+        cached = self.cache.get(cache_key, self.cache.ttl(url_portion))
+        extra_headers = {}
+        if cached and not cached.fresh:
+            # Revalidate an expired entry
+            if cached.etag:
+                extra_headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                extra_headers["If-Modified-Since"] = cached.last_modified
+        return cache_key, cached, extra_headers
+    
+    def query_result(self, cache_key, cached, status_code, body, headers):
+        """ Turn a fetched reply into make_query's result, storing 200 replies
+        in the cache and serving the cached body on 304.
+        Returns (status_code, response, cache outcome, parse seconds)."""
+        cache = "miss" if self.cache is not None else None
+        if status_code == 304 and cached:
+            self.cache.touch(cache_key)
+            parsed = time.time()
+            status_code, response, cache = cached.status, json.loads(cached.body), "revalidated"
+        elif status_code == 200:
+            if self.cache is not None:
+                self.cache.put(cache_key, status_code, body, headers.get("ETag"), headers.get("Last-Modified"))
+            parsed = time.time()
+            response = json.loads(body)
+        else:
+            parsed = time.time()
+            response = body
+        return status_code, response, cache, time.time() - parsed
+
+
+class EPOops(EPOopsBase):
+    
+    def __init__(self, config_file=None):
+        #Load Settings - defaults to config.ini alongside this file
+        settings = self.configure(config_file)
+        
+        # Pooled keep-alive session shared by all requests from this instance
+        self.timeout = (settings["CONNECT_TIMEOUT"], settings["READ_TIMEOUT"])
+        self.session = build_session(
+            settings["POOL_CONNECTIONS"],
+            settings["POOL_MAXSIZE"],
+            settings["MAX_RETRIES"],
+            settings["BACKOFF_FACTOR"]
+        )
+        self.token_lock = threading.Lock()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def close(self):
+        """ Close pooled connections held by the session, the response cache and the number mapping table. """
+        self.session.close()
+        self.close_stores()
     
     def authorise(self):
         string_to_encode = ":".join([self.consumer_key, self.consumer_secret])
@@ -85,38 +957,116 @@ class EPOops():
             "Host": self.host,
             "User-Agent": "Python urllib"
         } 
-        r = requests.post(self.auth_url, headers=headers, data=params)
+        started = time.time()
+        r = self.session.post(self.auth_url, headers=headers, data=params, timeout=self.timeout)
+        self.emit(self.auth_url.replace(self.base_url, ""), "POST", r.status_code, len(r.content), {
+            "service": "auth", "started": started, "attempts": 1,
+            "ttfb": r.elapsed.total_seconds(), "download": max(0, time.time() - started - r.elapsed.total_seconds())
+        })
         try:
-            self.access_token = r.json()['access_token']
+            self.accept_token(r.json())
         except:
             print (str(r.status_code))
             print (r.text)
+        return self.access_token
+    
+    def get_access_token(self):
+        """ Return a valid access token, authorising first if there is none
+        or it is about to expire. Only one thread refreshes at a time; the
+        others wait for and reuse its token."""
+        if self.token_valid():
+            return self.access_token
+        with self.token_lock:
+            if not self.token_valid():
+                self.authorise()
+            return self.access_token
+    
+    def refresh_token(self, rejected_token):
+        """ Replace a token OPS has rejected, unless another thread already has.
+        param string rejected_token: token sent with the rejected request"""
+        with self.token_lock:
+            if self.access_token == rejected_token:
+                self.authorise()
+            return self.access_token
         
     def build_request(self, data_url):
         headers = {
-            "Authorization" : "Bearer %s" % self.access_token,
+            "Authorization" : "Bearer %s" % self.get_access_token(),
             "Accept" : "application/json",
             "Connection": "Keep-Alive"
             }
             
-        url = "".join(["https://ops.epo.org", data_url])
+        url = "".join([self.base_url, data_url])
         return url, headers
         
-    def make_query(self, url_portion, params=None):
-        """Function to make a query and return json or statuscode / text."""
-        url, headers = self.build_request(url_portion)
-        r = requests.get(url, headers=headers, params=params)
-        if r.status_code == 400:
-            # Get new access token
-            self.authorise()
-            # Rebuild headers
+    def send(self, url, headers, params=None, data=None, stream=False):
+        """ GET the url, or POST data as plain text if data is given. """
+        if data is None:
+            return self.session.get(url, headers=headers, params=params, timeout=self.timeout, stream=stream)
+        headers["Content-Type"] = "text/plain"
+        return self.session.post(url, headers=headers, params=params, data=data, timeout=self.timeout, stream=stream)
+    
+    def fetch(self, url_portion, params=None, data=None, extra_headers=None, stream=False, stats=None):
+        """ Send a request and return the requests Response.
+        Requests are paced by the throttle controller, retried once with a new
+        access token on 400 and retried with backoff if OPS rejects them as
+        overloaded.
+        param dict extra_headers: headers added to the defaults from build_request
+        param bool stream: leave the body unread for incremental parsing
+        param dict stats: filled with attempts, token refreshes and timings for
+            the caller to report - if not given the request is reported here"""
+        report = stats is None
+        stats = {} if stats is None else stats
+        service = self.start_stats(url_portion, stats)
+        reauthorised = False
+        attempt = 0
+        while True:
+            waited = time.time()
+            self.throttle.acquire(service)
             url, headers = self.build_request(url_portion)
-            # Repeat request
-            r = requests.get(url, headers=headers, params=params)
-        if r.status_code == 200:
-            return r.status_code, r.json()
-        else:
-            return r.status_code, r.text
+            headers.update(extra_headers or {})
+            sent = time.time()
+            stats["wait"] += sent - waited
+            r = self.send(url, headers, params, data, stream)
+            stats["attempts"] += 1
+            stats["ttfb"] += r.elapsed.total_seconds()
+            stats["download"] += max(0, time.time() - sent - r.elapsed.total_seconds())
+            self.throttle.update(service, r.headers)
+            action = self.retry_action(r.status_code, r.headers, reauthorised, attempt)
+            if action == "refresh":
+                # Get new access token and repeat request
+                r.close()
+                self.refresh_token(headers["Authorization"][len("Bearer "):])
+                stats["token_refreshes"] += 1
+                reauthorised = True
+                continue
+            if action == "backoff":
+                # The acquire at the top of the loop waits out the pause
+                r.close()
+                self.throttle.defer(service, attempt, r.headers.get("Retry-After"))
+                attempt += 1
+                continue
+            if report:
+                size = len(r.content) if not stream else int(r.headers.get("Content-Length") or 0) or None
+                self.emit(url_portion, "GET" if data is None else "POST", r.status_code, size, stats)
+            return r
+    
+    def make_query(self, url_portion, params=None, data=None):
+        """Function to make a query and return json or statuscode / text.
+        If data is given the request is sent as a POST, e.g. for bulk lookups."""
+        stats = {"started": time.time()}
+        method = "GET" if data is None else "POST"
+        cache_key, cached, extra_headers = self.cache_lookup(url_portion, params, data)
+        if cached and cached.fresh:
+            parsed = time.time()
+            response = json.loads(cached.body)
+            self.emit(url_portion, method, cached.status, len(cached.body), stats, "hit", time.time() - parsed)
+            return cached.status, response
+        
+        r = self.fetch(url_portion, params, data, extra_headers, stats=stats)
+        status_code, response, cache, parse = self.query_result(cache_key, cached, r.status_code, r.text, r.headers)
+        self.emit(url_portion, method, r.status_code, len(r.content), stats, cache, parse)
+        return status_code, response
         
     def get_data(self, number, number_type="publication", data_type="biblio"):
         #number = publication or application number in epodoc standard
@@ -134,10 +1084,13 @@ class EPOops():
         data_url = "".join(["/3.1/rest-services/register/", number_type, "/epodoc/", number, "/", data_type])
         return self.make_query(data_url)
 
-    def get_published_desc(self, publication_number):
+    def get_published_desc(self, publication_number, stream=False):
         """ Get published description for application if it exists.
-        param int publication_number: publication number for application in EPO OPS form"""
+        param int publication_number: publication number for application in EPO OPS form
+        param bool stream: return a generator of paragraphs from iter_published_desc instead"""
         #http://ops.epo.org/3.1/rest-services/published-data/publication/epodoc/EP2197188/description
+        if stream:
+            return self.iter_published_desc(publication_number)
         number_type = "publication"
         data_type   = "description"
         data_url = "".join(["/3.1/rest-services/published-data/", number_type, "/epodoc/", publication_number, "/", data_type])
@@ -153,10 +1106,13 @@ class EPOops():
         else:
             return status_code, response
 
-    def get_published_claims(self, publication_number):
+    def get_published_claims(self, publication_number, stream=False):
         """ Get published claims for a published patent application.
-        param int publication number"""
+        param int publication number
+        param bool stream: return a generator of claim texts from iter_published_claims instead"""
         #In certain cases the claim_text is a single string containing all the claims
+        if stream:
+            return self.iter_published_claims(publication_number)
         number_type = "publication"
         data_type   = "claims"
         data_url = "".join(["/3.1/rest-services/published-data/", number_type, "/epodoc/", publication_number, "/", data_type])
@@ -169,134 +1125,197 @@ class EPOops():
             
         if status_code == 404:
             #Try claims of PCT publication if no claims for EP publication
-            #Get register entry
-            status_code, response = self.get_register(publication_number)
-            if status_code == 200:
-                wo_pub_no = None
-                for pub_ref in response["ops:world-patent-data"]["ops:register-search"]["reg:register-documents"]["reg:register-document"]["reg:bibliographic-data"]["reg:publication-reference"]:
-                    if pub_ref["reg:document-id"]["reg:country"]["$"] == "WO":
-                        wo_pub_no = "".join(["WO", pub_ref["reg:document-id"]["reg:doc-number"]["$"]])
-                if wo_pub_no:
-                    data_url = "".join(["/3.1/rest-services/published-data/", number_type, "/epodoc/", wo_pub_no, "/", data_type])
-                    print(data_url)
-                    status_code, response = self.make_query(data_url)
-                    if status_code == 200:
-                        claim_text = response["ops:world-patent-data"]["ftxt:fulltext-documents"]["ftxt:fulltext-document"]["claims"]["claim"]["claim-text"]
-                        return claim_text
+            wo_pub_no = self.get_wo_publication(publication_number)
+            if wo_pub_no:
+                data_url = "".join(["/3.1/rest-services/published-data/", number_type, "/epodoc/", wo_pub_no, "/", data_type])
+                print(data_url)
+                status_code, response = self.make_query(data_url)
+                if status_code == 200:
+                    claim_text = response["ops:world-patent-data"]["ftxt:fulltext-documents"]["ftxt:fulltext-document"]["claims"]["claim"]["claim-text"]
+                    return claim_text
             print("Claims not found")
             return None
         else:
             return None
     
-    def get_publications(self, epodoc_no):
-        # Function to take an epodoc application number and return publication number and date
-        pass
-    
-    def convert_number(self, country_code, application_no, filing_date = None):
-        data_url = "/3.1/rest-services/number-service/application/original/"
-        request_type = "/epodoc" #choice of this or docdb
-        if filing_date:
-            # Need to use strftime on filing date
-            data_url = data_url + country_code + ".(" + application_no + ")." + filing_date + request_type
-        else:
-            data_url = data_url + country_code + ".(" + application_no + ")" + request_type
-        
-        status_code, response = self.make_query(data_url)
-        
+    def get_wo_publication(self, publication_number):
+        """ Get the PCT (WO) publication number for an EP publication from the register, or None. """
+        status_code, response = self.get_register(publication_number)
+        wo_pub_no = None
         if status_code == 200:
-            doc_no = response["ops:world-patent-data"]["ops:standardization"]["ops:output"]["ops:application-reference"]["document-id"]["doc-number"]["$"]
-        else:
-            doc_no = None
-        return doc_no
-        
-    def appln_to_pub(self, country_code, application_no, filing_date = None):
-        """ Get a publication number for a given application number. """
-        epodoc_no = self.convert_number(country_code, application_no)
-        if epodoc_no:
-            appln_data = self.get_data(epodoc_no, number_type="application", data_type="biblio")
-            clean_data = self.clean_data(appln_data)
-            if clean_data["publication"]:
-                return clean_data["publication"][0]['number']
-    
-    def clean_data(self, data):
-        """ Flatten data structure holding key patent information.
-        param dict data: dictionary from parsed JSON"""
-        
-        cleaned_data = {}
+            for pub_ref in check_list(response["ops:world-patent-data"]["ops:register-search"]["reg:register-documents"]["reg:register-document"]["reg:bibliographic-data"]["reg:publication-reference"]):
+                if pub_ref["reg:document-id"]["reg:country"]["$"] == "WO":
+                    wo_pub_no = "".join(["WO", pub_ref["reg:document-id"]["reg:doc-number"]["$"]])
+        return wo_pub_no
+    
+    def iter_fulltext(self, publication_number, data_type, tag, within, lang=None):
+        """ Stream a fulltext XML response and yield the text of each tag element.
+        Returns None (rather than a generator) if the request fails so callers
+        can fall back to another publication."""
+        data_url = "".join(["/3.1/rest-services/published-data/publication/epodoc/", publication_number, "/", data_type])
+        r = self.fetch(data_url, extra_headers={"Accept": "application/xml"}, stream=True)
+        if r.status_code != 200:
+            r.close()
+            return None
         
-        # Check data relates to located document
-        data_to_check = safeget(data, "ops:world-patent-data", "exchange-documents", "exchange-document")
-        if isinstance(data_to_check, dict):
-            if data_to_check.get("@status") == "not found":
-                return "Error: document not found"
-            else:
-                exdoc = data_to_check
-        else:
-            if isinstance(data_to_check, list) and (len(data_to_check) > 0):
-                exdoc = data_to_check[0]
-            else:
-                return "Error: document not found"
-              
-        title_list = check_list(safeget(exdoc, "bibliographic-data", "invention-title"))
-        cleaned_data["title"] = [title.get("$", None) for title in title_list if title.get("@lang", None) == "en"][0]
-          
-        publication = check_list(safeget(exdoc, "bibliographic-data", "publication-reference", "document-id"))
-    
-        cleaned_data["publication"] = [
-            {
-                "number": safeget(pub_record, "doc-number", "$"), 
-                "date": safeget(pub_record, "date", "$")
-            } for pub_record in publication if (pub_record.get("@document-id-type", None) == "epodoc")]
-                  
-        cleaned_data["applicants"] = [safeget(applicant, "applicant-name", "name", "$") for applicant in safeget(exdoc, "bibliographic-data", "parties", "applicants", "applicant") if applicant.get("@data-format", None) == "epodoc"]
-            
-        cleaned_data["inventors"] = [safeget(inventor, "inventor-name", "name", "$") for inventor in safeget(exdoc, "bibliographic-data", "parties", "inventors", "inventor") if inventor.get("@data-format", None) == "epodoc"]
+        def generate():
+            with closing(r):
+                r.raw.decode_content = True
+                for text in iter_element_text(r.raw, tag, within=within, lang=lang):
+                    yield text
         
-        cleaned_data["application"] = [{"number": safeget(appln_record, "doc-number", "$"), "date": safeget(appln_record, "date", "$")} for appln_record in safeget(exdoc, "bibliographic-data", "application-reference", "document-id") if appln_record.get("@document-id-type", None) == "epodoc"]
+        return generate()
+    
+    def iter_published_desc(self, publication_number, lang=None):
+        """ Generator yielding description paragraphs one at a time from a
+        streamed XML response, so large descriptions are never held in memory.
+        param string lang: only yield paragraphs in this language, e.g. "EN" """
+        paragraphs = self.iter_fulltext(publication_number, "description", "p", "description", lang)
+        for paragraph in paragraphs or []:
+            yield paragraph
+    
+    def iter_published_claims(self, publication_number, lang=None):
+        """ Generator yielding claim texts one at a time from a streamed XML
+        response. Falls back to the PCT publication like get_published_claims.
+        param string lang: only yield claims in this language, e.g. "EN" """
+        claims = self.iter_fulltext(publication_number, "claims", "claim-text", "claims", lang)
+        if claims is None:
+            wo_pub_no = self.get_wo_publication(publication_number)
+            if wo_pub_no:
+                claims = self.iter_fulltext(wo_pub_no, "claims", "claim-text", "claims", lang)
+        if claims is None:
+            print("Claims not found")
+            return
+        for claim in claims:
+            yield claim
+    
+    def get_data_bulk(self, numbers, number_type="publication", data_type="biblio", batch_size=BULK_BATCH_SIZE, max_workers=1):
+        """ Bulk version of get_data using the OPS multi-number POST endpoint.
+        Numbers are sent in batches of up to batch_size and each combined
+        response is split back into single-number responses, so results can
+        be passed to clean_data as if they came from get_data.
+        Yields (number, response); if a batch fails every number in it gets the
+        error text (or raised exception) as its response.
+        param list numbers: numbers in epodoc standard
+        param int batch_size: numbers per request - OPS allows up to 100
+        param int max_workers: number of batches to fetch concurrently"""
+        data_url = "".join(["/3.1/rest-services/published-data/", number_type, "/epodoc/", data_type])
         
-        priority_list = check_list(safeget(exdoc, "bibliographic-data", "priority-claims", "priority-claim"))
-        cleaned_data["priorityclaims"] = []
-        for priority in priority_list:
-            for p_record in check_list(priority.get("document-id", None)):
-                if p_record.get("@document-id-type", None) == "epodoc":
-                    cleaned_data["priorityclaims"].append({"number": safeget(p_record, "doc-number", "$"), "date": safeget(p_record, "date", "$")})
+        def fetch_batch(batch):
+            status_code, response = self.make_query(data_url, data=",".join(batch))
+            if status_code == 200:
+                return list(split_exchange_documents(response, batch, number_type))
+            return [(number, response) for number in batch]
         
-        cleaned_data["classifications"] = [
-        {
-            "section" : safeget(classification, "section", "$"), 
-            "class" : safeget(classification, "class", "$") ,
-            "subclass" : safeget(classification, "subclass", "$"),
-            "maingroup": safeget(classification, "main-group", "$"),
-            "subgroup" : safeget(classification, "subgroup", "$")
-        } for classification in safeget(exdoc, "bibliographic-data", "patent-classifications", "patent-classification")]
+        return self._bulk(fetch_batch, numbers, batch_size, max_workers)
+    
+    def get_register_bulk(self, numbers, number_type="publication", data_type="biblio", batch_size=BULK_BATCH_SIZE, max_workers=1):
+        """ Bulk version of get_register. Yields (number, (status_code, response))
+        with each response shaped as if get_register had been called for that number. """
+        data_url = "".join(["/3.1/rest-services/register/", number_type, "/epodoc/", data_type])
         
-        cleaned_data["abstract"] = safeget(exdoc, "abstract", "p", "$")
+        def fetch_batch(batch):
+            status_code, response = self.make_query(data_url, data=",".join(batch))
+            if status_code == 200:
+                return list(split_register_documents(response, batch, number_type))
+            return [(number, (status_code, response)) for number in batch]
         
-        cleaned_data["citations"] = []
-        pub_list = []
-        for document in check_list(data_to_check):
-            if "references-cited" in document.get("bibliographic-data", None):
-                citation_list = check_list(safeget(document, "bibliographic-data", "references-cited", "citation"))
-                for citation in citation_list:
-                    for c_record in check_list(safeget(citation, "patcit", "document-id")):
-                        if c_record:
-                            if (c_record.get("@document-id-type", None) == "epodoc") and (safeget(c_record, "doc-number", "$") not in pub_list):
-                                cleaned_citation = {}
-                                cleaned_citation["number"] = safeget(c_record, "doc-number", "$")
-                                pub_list.append(safeget(c_record,"doc-number","$"))
-                                if "date" in c_record:
-                                    cleaned_citation["date"] = safeget(c_record, "date", "$")
-                                if "category" in citation:
-                                    cleaned_citation["category"] = safeget(citation, "category", "$")
-                                cleaned_data["citations"].append(cleaned_citation)            
+        return self._bulk(fetch_batch, numbers, batch_size, max_workers)
+    
+    def _bulk(self, fetch_batch, numbers, batch_size, max_workers):
+        """ Run fetch_batch over chunks of numbers and flatten the per-number results. """
+        for batch, results in run_many(fetch_batch, chunked(numbers, batch_size), max_workers):
+            if isinstance(results, Exception):
+                results = [(number, results) for number in batch]
+            for number, result in results:
+                yield number, result
+    
+    def get_data_many(self, numbers, number_type="publication", data_type="biblio", max_workers=None):
+        """ Concurrent version of get_data for a list of numbers.
+        Yields (number, response) in completion order; a failed lookup yields
+        the raised exception as its response.
+        param list numbers: numbers in epodoc standard
+        param int max_workers: worker threads - defaults to the connection pool size"""
+        return run_many(
+            lambda number: self.get_data(number, number_type=number_type, data_type=data_type),
+            numbers, max_workers or self.pool_maxsize)
+    
+    def get_register_many(self, numbers, number_type="publication", data_type="biblio", max_workers=None):
+        """ Concurrent version of get_register. Yields (number, (status_code, response)). """
+        return run_many(
+            lambda number: self.get_register(number, number_type=number_type, data_type=data_type),
+            numbers, max_workers or self.pool_maxsize)
+    
+    def get_published_claims_many(self, publication_numbers, max_workers=None):
+        """ Concurrent version of get_published_claims. Yields (number, claim_text). """
+        return run_many(self.get_published_claims, publication_numbers, max_workers or self.pool_maxsize)
+    
+    def get_published_desc_many(self, publication_numbers, max_workers=None):
+        """ Concurrent version of get_published_desc. Yields (number, description). """
+        return run_many(self.get_published_desc, publication_numbers, max_workers or self.pool_maxsize)
+    
+    def search(self, query, range_begin=1, range_end=25):
+        """ Run a published-data CQL search, e.g. "ct=EP1000000" for documents citing EP1000000.
+        param int range_begin, range_end: result range - OPS returns at most 100 per request"""
+        data_url = "/3.1/rest-services/published-data/search"
+        return self.make_query(data_url, params={"q": query, "Range": "%d-%d" % (range_begin, range_end)})
+    
+    def get_citing(self, number, max_results=100):
+        """ Numbers of documents citing a publication (forward citations). """
+        numbers = []
+        for range_begin in range(1, max_results + 1, 100):
+            range_end = min(range_begin + 99, max_results)
+            status_code, response = self.search("ct=%s" % number, range_begin, range_end)
+            if status_code != 200:
+                break
+            search = safeget(response, "ops:world-patent-data", "ops:biblio-search")
+            numbers.extend(reference_numbers(safeget(search, "ops:search-result", "ops:publication-reference")))
+            if range_end >= int(search.get("@total-result-count", 0)):
+                break
+        return numbers
+    
+    def get_equivalents(self, number, number_type="publication"):
+        """ Numbers of the simple-family equivalents of a document. """
+        response = self.get_data(number, number_type=number_type, data_type="equivalents")
+        results = safeget(response, "ops:world-patent-data", "ops:equivalents-inquiry", "ops:inquiry-result") if isinstance(response, dict) else None
+        if results is None:
+            return []
+        return reference_numbers([result.get("publication-reference") for result in check_list(results) if result])
+    
+    def get_publications(self, epodoc_no):
+        # Function to take an epodoc application number and return publication number and date
+        pass
+    
+    def convert_number(self, country_code, application_no, filing_date = None):
+        """ Epodoc application number for an original one, or None.
+        Conversions are memoised - see NumberNormaliser."""
+        return self.numbers.application_epodoc(country_code, application_no, filing_date)
         
-        return cleaned_data
+    def appln_to_pub(self, country_code, application_no, filing_date = None):
+        """ Get a publication number for a given application number.
+        Conversions are memoised - see NumberNormaliser."""
+        application = (country_code, application_no, filing_date)
+        return self.numbers.appln_to_pub_many([application])[application]
+    
+    def appln_to_pub_many(self, applications, max_workers=None):
+        """ Publication numbers for many (country_code, application_no[, filing_date]) tuples.
+        Uncached numbers are converted with concurrent number-service requests
+        and bulk biblio requests. Returns a dictionary keyed by the input tuples."""
+        return self.numbers.appln_to_pub_many(applications, max_workers)
+    
+    def clean_data(self, data, compact=False):
+        """ Flatten data structure holding key patent information.
+        param dict data: dictionary from parsed JSON
+        param bool compact: return a PatentRecord instead of a dictionary"""
+        return extract_record(data, compact)
     
     def get_earliestdate(self, clean_data):
         #Gets an earliest effective date, e.g. first priority or application date, from data cleaned with the method above
-        appln_dates = [datetime.strptime(appln["date"],"%Y%m%d") for appln in clean_data["application"]]
-        priority_dates = [datetime.strptime(priority["date"],"%Y%m%d") for priority in clean_data["priorityclaims"]]
-        date_list = appln_dates + priority_dates
-        earliest = min(date_list)
-        return earliest
+        #Returns None if the record has no usable dates - see timeline.Timeline for whole portfolios
+        if isinstance(clean_data, PatentRecord):
+            date_list = [ref.date for ref in clean_data.application + clean_data.priorityclaims if ref.date]
+        else:
+            date_list = [parse_date(ref["date"]) for ref in clean_data["application"] + clean_data["priorityclaims"]]
+            date_list = [date for date in date_list if date]
+        return min(date_list) if date_list else None
 
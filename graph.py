@@ -0,0 +1,212 @@
+# Python 2.7 and 3+ Version
+
+# Citation and family graph crawler
+#
+# Expands a set of seed publications breadth-first through backward
+# citations (references-cited in the biblio data), forward citations
+# (ct= searches) and simple-family equivalents. Every number is fetched at
+# most once: the frontier is de-duplicated against a set of every node
+# seen so far, and each level is fetched in bulk / on a worker pool.
+# Edges are collected into compressed sparse row (CSR) arrays.
+#
+# Edge direction: A -> B of kind "cites" means A cites B, whichever
+# direction it was discovered in; "equivalent" edges point from the
+# expanded document to its equivalent.
+
+from __future__ import print_function
+
+import json
+from xml.etree import ElementTree
+
+import numpy as np
+
+from epo_ops import BULK_BATCH_SIZE, KIND_CODE_RE, epodoc_key, extract_record, run_many
+
+# Expansion directions a crawl can follow
+DIRECTIONS = ["backward", "forward", "equivalents"]
+
+# Edge kinds, stored as their index in the kinds array
+EDGE_KINDS = ["cites", "equivalent"]
+
+def node_key(number):
+    """ Normalise a number to a graph node, e.g. "ep1000000.A1" -> "EP1000000". """
+    key = epodoc_key(number)
+    match = KIND_CODE_RE.match(key)
+    return match.group(1) if match else key
+
+
+class GraphBuilder():
+    """ Accumulates nodes and de-duplicated edges before conversion to CSR. """
+
+    def __init__(self):
+        self.nodes = []
+        self.ids = {}
+        self.edges = set()
+
+    def add_node(self, number):
+        node = self.ids.get(number)
+        if node is None:
+            node = self.ids[number] = len(self.nodes)
+            self.nodes.append(number)
+        return node
+
+    def add_edge(self, source, target, kind):
+        if source != target:
+            self.edges.add((self.add_node(source), self.add_node(target), EDGE_KINDS.index(kind)))
+
+    def to_csr(self):
+        edges = np.array(sorted(self.edges), dtype=np.int32).reshape(-1, 3)
+        indptr = np.zeros(len(self.nodes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edges[:, 0], minlength=len(self.nodes)), out=indptr[1:])
+        return CitationGraph(list(self.nodes), indptr, edges[:, 1].copy(), edges[:, 2].astype(np.int8))
+
+
+class CitationGraph():
+    """ Directed graph in CSR form: the out-edges of node i are
+    indices[indptr[i]:indptr[i + 1]] with kinds in the same slice of kinds.
+    nodes[i] is the number of node i."""
+
+    def __init__(self, nodes, indptr, indices, kinds):
+        self.nodes = nodes
+        self.ids = dict((number, node) for node, number in enumerate(nodes))
+        self.indptr = indptr
+        self.indices = indices
+        self.kinds = kinds
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def edge_count(self):
+        return len(self.indices)
+
+    def neighbours(self, number, kind=None):
+        """ Numbers a node has edges to, optionally only of one kind. """
+        node = self.ids.get(node_key(number))
+        if node is None:
+            return []
+        start, end = self.indptr[node], self.indptr[node + 1]
+        targets = self.indices[start:end]
+        if kind is not None:
+            targets = targets[self.kinds[start:end] == EDGE_KINDS.index(kind)]
+        return [self.nodes[target] for target in targets]
+
+    def in_degree(self, kind=None):
+        """ Array of incoming edge counts per node, e.g. times cited. """
+        indices = self.indices if kind is None else self.indices[self.kinds == EDGE_KINDS.index(kind)]
+        return np.bincount(indices, minlength=len(self.nodes))
+
+    def out_degree(self):
+        return np.diff(self.indptr)
+
+    def edges(self):
+        """ Generator of (source, target, kind) numbers. """
+        sources = np.repeat(np.arange(len(self.nodes)), self.out_degree())
+        for source, target, kind in zip(sources, self.indices, self.kinds):
+            yield self.nodes[source], self.nodes[target], EDGE_KINDS[kind]
+
+    def save(self, path):
+        """ Save the CSR arrays and node list to a .npz file. """
+        np.savez_compressed(path, indptr=self.indptr, indices=self.indices, kinds=self.kinds,
+                            nodes=np.array(json.dumps(self.nodes)))
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        return cls(json.loads(str(arrays["nodes"])), arrays["indptr"], arrays["indices"], arrays["kinds"])
+
+    def write_edgelist(self, filename):
+        """ Write a tab separated source / target / kind file. """
+        with open(filename, "w") as f:
+            for source, target, kind in self.edges():
+                f.write("%s\t%s\t%s\n" % (source, target, kind))
+
+    def write_graphml(self, filename):
+        """ Write GraphML for tools such as Gephi, yEd or networkx. """
+        root = ElementTree.Element("graphml", xmlns="http://graphml.graphdrawing.org/xmlns")
+        ElementTree.SubElement(root, "key", {"id": "kind", "for": "edge", "attr.name": "kind", "attr.type": "string"})
+        graph = ElementTree.SubElement(root, "graph", id="citations", edgedefault="directed")
+        for number in self.nodes:
+            ElementTree.SubElement(graph, "node", id=number)
+        for source, target, kind in self.edges():
+            edge = ElementTree.SubElement(graph, "edge", source=source, target=target)
+            ElementTree.SubElement(edge, "data", key="kind").text = kind
+        ElementTree.ElementTree(root).write(filename, encoding="utf-8", xml_declaration=True)
+
+
+class CitationCrawler():
+    """ Breadth-first crawl of the citation / family neighbourhood of seed patents.
+    Each level's frontier is fetched as a whole: biblio data (for backward
+    citations) through the bulk endpoint, forward citation searches and
+    equivalents on a worker pool. Numbers that fail to fetch are recorded
+    in errors and kept as nodes without expansion."""
+
+    def __init__(self, client, directions=("backward", "forward", "equivalents"), max_workers=None,
+                 batch_size=BULK_BATCH_SIZE, max_citing=100):
+        """ param EPOops client: client used for fetching
+        param tuple directions: any of DIRECTIONS
+        param int max_workers: concurrent requests - defaults to the client's pool size
+        param int batch_size: numbers per bulk biblio request
+        param int max_citing: forward citations fetched per document"""
+        for direction in directions:
+            if direction not in DIRECTIONS:
+                raise ValueError("Unknown crawl direction: %s" % direction)
+        self.client = client
+        self.directions = directions
+        self.max_workers = max_workers or client.pool_maxsize
+        self.batch_size = batch_size
+        self.max_citing = max_citing
+        self.errors = {}
+
+    def expand(self, frontier):
+        """ Generator of (source, target, kind) edges for every number in the frontier. """
+        if "backward" in self.directions:
+            for number, response in self.client.get_data_bulk(frontier, batch_size=self.batch_size,
+                                                              max_workers=self.max_workers):
+                record = extract_record(response) if isinstance(response, dict) else response
+                if not isinstance(record, dict):
+                    self.errors[number] = str(record)
+                    continue
+                for citation in record["citations"]:
+                    yield number, node_key(citation["number"]), "cites"
+        if "forward" in self.directions:
+            for number, citing in run_many(lambda number: self.client.get_citing(number, self.max_citing),
+                                           frontier, self.max_workers):
+                if isinstance(citing, Exception):
+                    self.errors[number] = repr(citing)
+                    continue
+                for citing_number in citing:
+                    yield node_key(citing_number), number, "cites"
+        if "equivalents" in self.directions:
+            for number, equivalents in run_many(self.client.get_equivalents, frontier, self.max_workers):
+                if isinstance(equivalents, Exception):
+                    self.errors[number] = repr(equivalents)
+                    continue
+                for equivalent in equivalents:
+                    yield number, node_key(equivalent), "equivalent"
+
+    def crawl(self, seeds, depth=2):
+        """ Crawl to depth hops from the seeds and return a CitationGraph.
+        Nodes first reached at the last hop are included but not expanded.
+        param iterable seeds: publication numbers in epodoc standard
+        param int depth: number of hops to expand"""
+        builder = GraphBuilder()
+        frontier = []
+        for seed in seeds:
+            seed = node_key(seed)
+            if seed not in builder.ids:
+                builder.add_node(seed)
+                frontier.append(seed)
+        seen = set(frontier)
+        for hop in range(depth):
+            if not frontier:
+                break
+            next_frontier = []
+            for source, target, kind in self.expand(frontier):
+                builder.add_edge(source, target, kind)
+                for number in (source, target):
+                    if number not in seen:
+                        seen.add(number)
+                        next_frontier.append(number)
+            frontier = next_frontier
+        return builder.to_csr()
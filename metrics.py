@@ -0,0 +1,212 @@
+# Python 2.7 and 3+ Version
+
+# Request metrics for EPOops and AsyncEPOops
+#
+# Clients report every request as a RequestEvent to the hooks added with
+# add_hook. RequestMetrics is a ready-made hook aggregating counters and
+# latency histograms per OPS service and url template.
+
+from __future__ import print_function
+
+import json
+import threading
+import time
+from collections import namedtuple
+
+def ops_service(url_portion):
+    """ Name of the OPS throttling service a request url counts against.
+    Register and number-service requests count against "other". """
+    if "/search" in url_portion:
+        return "search"
+    if "/family/" in url_portion or "/legal/" in url_portion:
+        return "inpadoc"
+    if "/published-data/images" in url_portion:
+        return "images"
+    if "/published-data/" in url_portion:
+        return "retrieval"
+    return "other"
+
+def url_template(url_portion):
+    """ Request url with the document number replaced by {number}, so metrics
+    group by endpoint, e.g. "/3.1/rest-services/published-data/publication/epodoc/{number}/biblio". """
+    parts = url_portion.split("/")
+    for i in range(len(parts) - 2):
+        if parts[i] in ("epodoc", "docdb", "original"):
+            parts[i + 1] = "{number}"
+    return "/".join(parts)
+
+
+# Passed to each hook added with EPOops.add_hook after every request.
+# cache is "hit", "revalidated", "miss" or None without a cache; attempts counts
+# HTTP requests sent, including retries and the repeat after a token refresh.
+# Times are in seconds: wait for the throttle and backoff, ttfb until response
+# headers arrived (summed over attempts, including DNS, connect and TLS on new
+# connections), download of the body, parse of the JSON and total.
+RequestEvent = namedtuple("RequestEvent", [
+    "service", "url_template", "method", "status", "bytes", "cache", "attempts", "retries",
+    "token_refreshes", "throttle_state", "system_state", "wait", "ttfb", "download", "parse", "total"
+])
+
+# Histogram bucket upper bounds in milliseconds
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000]
+
+class Histogram():
+    """ Fixed-bucket latency histogram. """
+    
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+    
+    def add(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+    
+    def percentile(self, fraction):
+        """ Upper bound of the bucket holding the given fraction of values. """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + [self.max], self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+    
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(0.50),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "buckets": dict(zip([str(bound) for bound in self.buckets] + ["inf"], self.counts))
+        }
+
+
+class RequestMetrics():
+    """ In-process aggregator of RequestEvents, grouped by service and url template.
+    Keeps counters (requests, bytes, retries, token refreshes, cache results,
+    status codes) and latency histograms in milliseconds for each phase.
+    Add it as a hook with EPOops.add_hook, or call EPOops.enable_metrics.
+    Safe to share between threads."""
+    
+    PHASES = ["total", "wait", "ttfb", "download", "parse"]
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.endpoints = {}
+        self.throttle = {}
+        self.system_state = None
+    
+    def __call__(self, event):
+        key = (event.service, event.url_template)
+        with self.lock:
+            endpoint = self.endpoints.get(key)
+            if endpoint is None:
+                endpoint = self.endpoints[key] = {
+                    "counters": {}, "latency": dict((phase, Histogram()) for phase in self.PHASES)}
+            counters = endpoint["counters"]
+            updates = [
+                ("requests", 1), ("bytes", event.bytes or 0), ("attempts", event.attempts),
+                ("retries", event.retries), ("token_refreshes", event.token_refreshes),
+                ("status_%s" % event.status, 1)
+            ]
+            if event.cache:
+                updates.append(("cache_%s" % event.cache, 1))
+            for name, value in updates:
+                counters[name] = counters.get(name, 0) + value
+            for phase in self.PHASES:
+                value = getattr(event, phase)
+                if value is not None:
+                    endpoint["latency"][phase].add(value * 1000)
+            if event.throttle_state:
+                self.throttle[event.service] = event.throttle_state
+            if event.system_state:
+                self.system_state = event.system_state
+    
+    def snapshot(self):
+        """ Dictionary of everything recorded so far. """
+        with self.lock:
+            return {
+                "seconds": time.time() - self.started,
+                "system_state": self.system_state,
+                "throttle": dict(self.throttle),
+                "endpoints": [
+                    {
+                        "service": service,
+                        "url_template": template,
+                        "counters": dict(endpoint["counters"]),
+                        "latency_ms": dict((phase, histogram.to_dict()) for phase, histogram in endpoint["latency"].items())
+                    }
+                    for (service, template), endpoint in sorted(self.endpoints.items())
+                ]
+            }
+    
+    def dump_json(self, indent=1):
+        return json.dumps(self.snapshot(), indent=indent, sort_keys=True)
+    
+    def dump_text(self):
+        """ Table of requests, bytes, retries, cache hits and latency per endpoint. """
+        snapshot = self.snapshot()
+        lines = ["%-8s %-70s %7s %10s %7s %6s %9s %9s %9s" % (
+            "service", "url template", "reqs", "bytes", "retries", "hits", "p50 ms", "p95 ms", "ttfb p95")]
+        for endpoint in snapshot["endpoints"]:
+            counters = endpoint["counters"]
+            total = endpoint["latency_ms"]["total"]
+            ttfb = endpoint["latency_ms"]["ttfb"]
+            lines.append("%-8s %-70s %7d %10d %7d %6d %9.1f %9.1f %9.1f" % (
+                endpoint["service"], endpoint["url_template"][:70], counters.get("requests", 0),
+                counters.get("bytes", 0), counters.get("retries", 0), counters.get("cache_hit", 0),
+                total["p50"] or 0, total["p95"] or 0, ttfb["p95"] or 0))
+        lines.append("system state: %s  throttle: %s" % (snapshot["system_state"], ", ".join(
+            "%s=%s" % item for item in sorted(snapshot["throttle"].items()))))
+        return "\n".join(lines)
+
+
+class RequestHooks(object):
+    """ Hook registration and RequestEvent reporting shared by the sync and
+    async clients. Expects hooks and throttle attributes. """
+    
+    def add_hook(self, hook):
+        """ Call hook(event) with a RequestEvent after every request. Hooks run
+        on the requesting thread or event loop, so should be quick and thread-safe. """
+        self.hooks.append(hook)
+    
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+    
+    def enable_metrics(self):
+        """ Add and return a RequestMetrics aggregator, e.g. print(client.enable_metrics().dump_text()) later. """
+        metrics = RequestMetrics()
+        self.add_hook(metrics)
+        return metrics
+    
+    def emit(self, url_portion, method, status, size, stats, cache=None, parse=None):
+        """ Build a RequestEvent from the stats collected by fetch and pass it to the hooks. """
+        if not self.hooks:
+            return
+        service = stats.get("service") or ops_service(url_portion)
+        colour, rate = self.throttle.services.get(service, (None, 0))
+        attempts = stats.get("attempts", 0)
+        event = RequestEvent(
+            service, url_template(url_portion), method, status, size, cache, attempts, max(0, attempts - 1),
+            stats.get("token_refreshes", 0), colour, self.throttle.system_state,
+            stats.get("wait"), stats.get("ttfb"), stats.get("download"), parse,
+            time.time() - stats["started"]
+        )
+        for hook in self.hooks:
+            hook(event)
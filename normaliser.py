@@ -0,0 +1,283 @@
+# Python 2.7 and 3+ Version
+
+# Memoised application -> epodoc -> publication number conversion
+#
+# NumberNormaliser answers from an in-memory LRU and an optional SQLite
+# mapping table, converts EP application numbers locally and only asks OPS
+# for the rest. EPOops and AsyncEPOops share it through EPOopsBase.
+
+from __future__ import print_function
+
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Number normalisation defaults - set MAPPING_PATH in the [Numbers] section of config.ini
+# to keep converted numbers between runs
+NUMBERS_DEFAULTS = {
+    "MAPPING_PATH": "",
+    "LRU_SIZE": 100000
+}
+
+# EP application number in original format, e.g. "EP 99309477.2", "13180001"
+EP_APPLICATION_RE = re.compile(r"^(?:EP)?([0-9]{2})([0-9]{6})(?:[0-9])?$")
+
+# EP application number already in epodoc format, e.g. "EP19990309477"
+EP_EPODOC_APPLICATION_RE = re.compile(r"^EP(?:19|20)[0-9]{9}$")
+
+def local_application_epodoc(country_code, application_no):
+    """ Epodoc form of an application number that can be derived without the
+    number-service, or None. EP applications YYNNNNNN(.C) become
+    EP + YYYY + 0NNNNNN, e.g. "99309477.2" -> "EP19990309477"."""
+    if country_code.upper() != "EP":
+        return None
+    number = re.sub(r"[\s.]", "", application_no.upper())
+    if EP_EPODOC_APPLICATION_RE.match(number):
+        return number
+    match = EP_APPLICATION_RE.match(number)
+    if not match:
+        return None
+    year, serial = match.groups()
+    # EP filings start in 1978
+    century = "19" if int(year) >= 78 else "20"
+    return "EP" + century + year + "0" + serial
+
+
+def number_service_url(country_code, application_no, filing_date=None):
+    """ Number-service URL converting an original application number to epodoc. """
+    data_url = "/3.1/rest-services/number-service/application/original/"
+    request_type = "/epodoc" #choice of this or docdb
+    if filing_date:
+        # Need to use strftime on filing date
+        return data_url + country_code + ".(" + application_no + ")." + filing_date + request_type
+    return data_url + country_code + ".(" + application_no + ")" + request_type
+
+def standardized_number(response):
+    """ Epodoc document number from a parsed number-service response. """
+    return response["ops:world-patent-data"]["ops:standardization"]["ops:output"]["ops:application-reference"]["document-id"]["doc-number"]["$"]
+
+def not_found_response(response):
+    """ True if an error response body is the OPS "not found" fault rather than a transient failure. """
+    return not isinstance(response, (dict, Exception)) and "EntityNotFound" in response
+
+
+class LRUCache():
+    """ Thread-safe in-memory least recently used mapping. """
+    
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+    
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+    
+    def __len__(self):
+        return len(self.items)
+
+
+class NumberMapping():
+    """ Persistent SQLite table of converted numbers, e.g.
+    ("application", "EP.(13180001)") -> "EP20130180001" or
+    ("publication", "EP20130180001") -> "EP2000000". Safe to share between threads."""
+    
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS numbers (kind TEXT, input TEXT, output TEXT, stored REAL, "
+            "PRIMARY KEY (kind, input))")
+        # Unpublished applications stored by earlier versions - see NumberNormaliser.store
+        self.conn.execute("DELETE FROM numbers WHERE kind = 'publication' AND output IS NULL")
+        self.conn.commit()
+    
+    def get_many(self, kind, keys):
+        """ Dictionary of input -> output for the keys that are stored. """
+        found = {}
+        keys = list(keys)
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                found.update(self.conn.execute(
+                    "SELECT input, output FROM numbers WHERE kind = ? AND input IN (%s)" % ",".join("?" * len(chunk)),
+                    [kind] + chunk).fetchall())
+        return found
+    
+    def put_many(self, kind, mapping):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO numbers VALUES (?, ?, ?, ?)",
+                [(kind, key, value, now) for key, value in mapping.items()])
+            self.conn.commit()
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class NumberNormaliser():
+    """ Memoised application -> epodoc -> publication number conversion.
+    Lookups go to an in-memory LRU, then the persistent mapping table (if
+    configured), then local parsing for formats that can be converted
+    deterministically, and only then to OPS: the number-service for other
+    application numbers and bulk application biblio requests for
+    publication numbers. Definite answers - conversions and OPS "not found"
+    replies - are stored in both caches, except that unpublished applications
+    are only remembered in memory; transient failures (exceptions, other
+    error statuses, failed bulk batches) are not stored, so they are retried."""
+    
+    def __init__(self, client, mapping_path=None, lru_size=NUMBERS_DEFAULTS["LRU_SIZE"]):
+        """ param EPOops client: client used for OPS lookups
+        param string mapping_path: SQLite file for the persistent mapping table
+        param int lru_size: conversions kept in memory"""
+        self.client = client
+        self.memory = LRUCache(lru_size)
+        self.mapping = NumberMapping(mapping_path) if mapping_path else None
+    
+    def lookup(self, kind, keys):
+        """ Dictionary of cached conversions for keys; misses are left out. """
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.memory.get((kind, key), self)
+            if value is self:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing and self.mapping is not None:
+            stored = self.mapping.get_many(kind, missing)
+            for key, value in stored.items():
+                self.memory.put((kind, key), value)
+            found.update(stored)
+        return found
+    
+    def store(self, kind, mapping):
+        """ Memoise definite answers, including None for numbers OPS does not know.
+        An application without a publication gets one once it is published, so
+        those None answers are only kept in memory and never persisted."""
+        for key, value in mapping.items():
+            self.memory.put((kind, key), value)
+        if kind == "publication":
+            mapping = dict((key, value) for key, value in mapping.items() if value is not None)
+        if self.mapping is not None and mapping:
+            self.mapping.put_many(kind, mapping)
+    
+    def application_key(self, country_code, application_no, filing_date=None):
+        key = "%s.(%s)" % (country_code.upper(), application_no.strip())
+        return key + "." + filing_date if filing_date else key
+    
+    def pending_applications(self, applications):
+        """ Resolve what can be resolved without OPS.
+        Returns (keys, found, remote): input tuple -> memo key, memo key ->
+        epodoc number for cached and locally parsed numbers, and the distinct
+        tuples that need the number-service."""
+        keys = dict((application, self.application_key(*application)) for application in applications)
+        found = self.lookup("application", set(keys.values()))
+        local = {}
+        remote = []
+        for application, key in keys.items():
+            if key in found or key in local:
+                continue
+            epodoc = local_application_epodoc(application[0], application[1])
+            if epodoc:
+                local[key] = epodoc
+            else:
+                remote.append(application)
+        self.store("application", local)
+        found.update(local)
+        return keys, found, list(dict.fromkeys(remote))
+    
+    def application_result(self, result):
+        """ (epodoc, definite) for a number-service (status_code, response) or raised exception. """
+        if isinstance(result, Exception):
+            return None, False
+        status_code, response = result
+        if status_code == 200:
+            return standardized_number(response), True
+        return None, status_code == 404
+    
+    def application_epodoc_many(self, applications, max_workers=None):
+        """ Convert (country_code, application_no, filing_date) tuples to epodoc
+        application numbers. Returns a dictionary keyed by the input tuples;
+        numbers that could not be converted map to None.
+        param int max_workers: concurrent number-service requests"""
+        applications = [tuple(application) + (None,) * (3 - len(application)) for application in applications]
+        # epo_ops imports this module
+        from epo_ops import run_many
+        keys, found, remote = self.pending_applications(applications)
+        definite = {}
+        for application, result in run_many(lambda application: self.client.make_query(number_service_url(*application)),
+                                            remote, max_workers or self.client.pool_maxsize):
+            epodoc, known = self.application_result(result)
+            found[keys[application]] = epodoc
+            if known:
+                definite[keys[application]] = epodoc
+        self.store("application", definite)
+        return dict((application, found.get(key)) for application, key in keys.items())
+    
+    def pending_publications(self, epodoc_applications):
+        """ Returns (found, missing): cached conversions and the distinct numbers still to fetch. """
+        found = self.lookup("publication", set(epodoc_applications))
+        return found, [number for number in dict.fromkeys(epodoc_applications) if number not in found]
+    
+    def publication_result(self, response):
+        """ (publication, definite) for one split bulk response, error text or exception. """
+        if isinstance(response, dict):
+            record = self.client.clean_data(response)
+            if isinstance(record, dict):
+                return (record["publication"][0]["number"] if record["publication"] else None), True
+            # Numbers missing from a successful bulk reply get a "not found" exchange-document
+            return None, True
+        return None, not_found_response(response)
+    
+    def publication_many(self, epodoc_applications, max_workers=1):
+        """ First publication number for each epodoc application number.
+        Uncached numbers are looked up with bulk application biblio requests,
+        so the number of requests is bounded by the batch size rather than
+        the number of rows. Returns a dictionary; unknown numbers map to None."""
+        epodoc_applications = [number for number in epodoc_applications if number]
+        found, missing = self.pending_publications(epodoc_applications)
+        definite = {}
+        if missing:
+            for number, response in self.client.get_data_bulk(missing, number_type="application", max_workers=max_workers):
+                found[number], known = self.publication_result(response)
+                if known:
+                    definite[number] = found[number]
+        self.store("publication", definite)
+        return dict((number, found.get(number)) for number in epodoc_applications)
+    
+    def application_epodoc(self, country_code, application_no, filing_date=None):
+        application = (country_code, application_no, filing_date)
+        return self.application_epodoc_many([application])[application]
+    
+    def appln_to_pub_many(self, applications, max_workers=None):
+        """ Publication numbers for (country_code, application_no[, filing_date]) tuples.
+        Returns a dictionary keyed by the input tuples."""
+        applications = [tuple(application) for application in applications]
+        epodocs = self.application_epodoc_many(applications, max_workers)
+        publications = self.publication_many(epodocs.values(), max_workers or 1)
+        return dict(
+            (application, publications.get(epodocs[tuple(application) + (None,) * (3 - len(application))]))
+            for application in applications
+        )
+    
+    def close(self):
+        if self.mapping is not None:
+            self.mapping.close()
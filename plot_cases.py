@@ -3,9 +3,10 @@ import urllib, urllib2
 import httplib
 import json
 import base64
-from xml.dom.minidom import Document, parseString
+from io import BytesIO
 import logging
 import time
+from classifications import ClassificationCounter
 
 class EPOops():
 	
@@ -23,14 +24,8 @@ class EPOops():
 		#Set filename
 		self.filename = filename
 		
-		#Initialise list for classification strings
-		self.c_list = []
-		
-		#Initialise new dom document for classification XML
-		self.save_doc = Document()
-
-		root = self.save_doc.createElement('classifications')
-		self.save_doc.appendChild(root)
+		#Initialise running counts of classifications
+		self.counter = ClassificationCounter()
 
 	def authorise(self):
 		b64string = base64.b64encode(":".join([self.consumer_key, self.consumer_secret]))
@@ -81,39 +76,26 @@ class EPOops():
 		return XML_data
 		
 	def extract_classification(self, xml_str):
-		#extract the <patent-classification> elements
-		dom = parseString(xml_str)
-		#Select first publication for classification extraction
-		first_pub = dom.getElementsByTagName('exchange-document')[0]
-		self.c_list = self.c_list + [node.childNodes[1].childNodes[0].nodeValue for node in first_pub.getElementsByTagName('classification-ipcr')]
-		#for node in first_pub.getElementsByTagName('classification-ipcr'):
-			#node.childNodes[1].childNodes[0].nodeValue
+		#count the <patent-classification> elements of the first publication as they are parsed
+		#returns the <classification-ipcr> strings of the first publication, e.g.
 			#G11B  27/    00            A I                    
 			#G11B  23/    28            A I                    
-			#G11B  27/    11            A I
-		
-		for node in first_pub.getElementsByTagName('patent-classification'):
-			self.save_doc.firstChild.appendChild(node)
+		return self.counter.add_xml(BytesIO(xml_str))
 			
 	def total_classifications(self):
-		number_list = []
-		
-		#Get list of publication numbers - file name when initialising object?
-		with open("cases.txt", "r") as f:
-			for line in f:
-				number_list.append(line.replace("/",""))
+		#Stream publication numbers from cases.txt - counts and classification strings
+		#are updated as each document arrives rather than held until the end
+		with open("cases.txt", "r") as cases, open("classification_list.txt", "wb") as c_file:
+			for line in cases:
+				number = line.replace("/","").strip()
+				if not number:
+					continue
+				logging.info(number)
+				XML_data = self.get_data(number)
+				#time.sleep(1) 
+				for c_string in self.extract_classification(XML_data):
+					c_file.write(str(c_string) + "\n")
 		
-		for number in number_list:
-			logging.error(number)
-			XML_data = self.get_data(number.strip())
-			#time.sleep(1) 
-			self.extract_classification(XML_data)
-		
-		#Save list to file
-		with open("classification_list.txt", "wb") as f:
-			f.write("\n".join(str(x) for x in self.c_list))
-		
-		#Save xmldoc to file
-		with open("save_doc.xml", "wb") as f:
-			self.save_doc.writexml(f)
-
+		#Save counts for process_classifications.py
+		self.counter.save("results.pkl")
+		return self.counter.upper_dict
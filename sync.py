@@ -0,0 +1,359 @@
+# Python 2.7 and 3+ Version
+
+# Resumable portfolio sync
+#
+# Fetches biblio and / or register data for a list of numbers with EPOops
+# and appends the results to an output directory in batches. A SQLite
+# checkpoint records the state of every number, so an interrupted run
+# resumes where it stopped and later runs only fetch numbers that are new,
+# failed or older than refresh_after - and only write those whose content
+# has changed.
+#
+# Layout of an output directory:
+#   checkpoint.db              per-number fetch state and the list of written batches
+#   batch-00000.jsonl          one JSON line per new or changed record:
+#                              {"number", "source", "fetched", "data"}
+#
+# Usage: python sync.py cases.txt output_dir [--register] [--refresh-days 7]
+
+from __future__ import print_function
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from epo_ops import EPOops, BULK_BATCH_SIZE, check_list, safeget
+
+# Data sources a sync can fetch for each number
+SOURCES = ["biblio", "register"]
+
+def read_cases(filename):
+    """ Generator of numbers from a cases.txt style file, one per line. """
+    with open(filename) as f:
+        for line in f:
+            number = line.replace("/", "").strip()
+            if number:
+                yield number
+
+def content_hash(data):
+    """ Stable hash of a parsed response, used to detect changed documents. """
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+def response_error(source, response):
+    """ Error message for a failed get_data / get_register response, or None.
+    Bulk biblio responses mark numbers OPS did not return as "not found"."""
+    if isinstance(response, Exception):
+        return repr(response)
+    if source == "register":
+        status_code, response = response
+        if status_code != 200:
+            return "%s: %s" % (status_code, response)
+        return None
+    if not isinstance(response, dict):
+        return str(response)
+    documents = check_list(safeget(response, "ops:world-patent-data", "exchange-documents", "exchange-document"))
+    if all(document.get("@status") == "not found" for document in documents if document):
+        return "not found"
+    return None
+
+
+class SyncCheckpoint():
+    """ SQLite record of what has been fetched and written.
+    Each number / source pair has a status ("done" or "failed"), the hash of
+    its last written content, when it was last fetched successfully, when it
+    was last attempted, the number of consecutive failed attempts and the
+    batch its current content is in. Batches are recorded in the same
+    transaction as the documents they contain."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "number TEXT, source TEXT, status TEXT, hash TEXT, fetched REAL, attempts INTEGER, "
+            "error TEXT, batch INTEGER, attempted REAL, PRIMARY KEY (number, source))")
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(documents)")]
+        if "attempted" not in columns:
+            # Checkpoints written before attempts were timed separately
+            self.conn.execute("ALTER TABLE documents ADD COLUMN attempted REAL")
+            self.conn.execute("UPDATE documents SET attempted = fetched")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS batches (batch INTEGER PRIMARY KEY, records INTEGER, written REAL)")
+        self.conn.commit()
+
+    def batches(self):
+        """ Ids of the batches whose contents have been committed. """
+        return set(row[0] for row in self.conn.execute("SELECT batch FROM batches"))
+
+    def next_batch(self):
+        return self.conn.execute("SELECT COALESCE(MAX(batch) + 1, 0) FROM batches").fetchone()[0]
+
+    def rows(self, numbers, source):
+        """ Dictionary of number -> (status, fetched, attempted, attempts, error) for stored numbers. """
+        rows = {}
+        for chunk in [numbers[i:i + 500] for i in range(0, len(numbers), 500)]:
+            rows.update(
+                (row[0], row[1:]) for row in self.conn.execute(
+                    "SELECT number, status, fetched, attempted, attempts, error FROM documents "
+                    "WHERE source = ? AND number IN (%s)" % ",".join("?" * len(chunk)), [source] + chunk)
+            )
+        return rows
+
+    def due(self, numbers, source, refresh_after=None, max_attempts=3):
+        """ The numbers that need fetching: never fetched, failed fewer than
+        max_attempts times in a row, or last fetched more than refresh_after
+        seconds ago. A failed refresh leaves the number due, so it is retried
+        on the next run. Numbers that have failed max_attempts times are only
+        tried again once refresh_after has passed since the last attempt.
+        param list numbers: numbers in the portfolio
+        param float refresh_after: seconds before a done number is fetched again - None never refreshes"""
+        now = time.time()
+        rows = self.rows(numbers, source)
+        due = []
+        for number in numbers:
+            if number not in rows:
+                due.append(number)
+                continue
+            status, fetched, attempted, attempts, error = rows[number]
+            if status == "done" and (refresh_after is None or now - fetched < refresh_after):
+                continue
+            if attempts < max_attempts:
+                due.append(number)
+            elif refresh_after is not None and now - (attempted or 0) >= refresh_after:
+                due.append(number)
+        return due
+
+    def exhausted(self, numbers, source, max_attempts=3):
+        """ (number, attempts, error) for numbers that have failed max_attempts
+        times in a row and will not be retried until refresh_after has passed. """
+        return [
+            (number, row[3], row[4])
+            for number, row in sorted(self.rows(numbers, source).items())
+            if row[3] >= max_attempts
+        ]
+
+    def hashes(self, numbers, source):
+        """ Dictionary of number -> hash of its last written content. """
+        hashes = {}
+        for chunk in [numbers[i:i + 500] for i in range(0, len(numbers), 500)]:
+            hashes.update(self.conn.execute(
+                "SELECT number, hash FROM documents WHERE source = ? AND hash IS NOT NULL AND number IN (%s)"
+                % ",".join("?" * len(chunk)), [source] + chunk).fetchall())
+        return hashes
+
+    def commit(self, batch, written, results):
+        """ Record one fetched chunk.
+        param int batch: id of the batch file holding the written records, or None
+        param int written: number of records in that batch
+        param list results: (number, source, hash or None, error or None, changed) tuples"""
+        now = time.time()
+        with self.conn:
+            if batch is not None:
+                self.conn.execute("INSERT INTO batches VALUES (?, ?, ?)", (batch, written, now))
+            for number, source, digest, error, changed in results:
+                if error is None:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO documents "
+                        "(number, source, status, hash, fetched, attempted, attempts, error, batch) "
+                        "VALUES (?, ?, 'done', ?, ?, ?, 0, NULL, "
+                        "CASE WHEN ? THEN ? ELSE (SELECT batch FROM documents WHERE number = ? AND source = ?) END)",
+                        (number, source, digest, now, now, changed, batch, number, source))
+                else:
+                    # Keep the last good content, batch and fetch time if there were any,
+                    # so a failed refresh stays due
+                    self.conn.execute(
+                        "INSERT OR IGNORE INTO documents "
+                        "(number, source, status, hash, fetched, attempted, attempts, error, batch) "
+                        "VALUES (?, ?, 'failed', NULL, NULL, ?, 0, ?, NULL)",
+                        (number, source, now, error))
+                    self.conn.execute(
+                        "UPDATE documents SET attempted = ?, attempts = attempts + 1, error = ? "
+                        "WHERE number = ? AND source = ?",
+                        (now, error, number, source))
+
+    def counts(self):
+        """ Dictionary of (source, status) -> number of documents. """
+        return dict(
+            ((source, status), count) for source, status, count in self.conn.execute(
+                "SELECT source, status, COUNT(*) FROM documents GROUP BY source, status")
+        )
+
+    def close(self):
+        self.conn.close()
+
+
+class PortfolioSync():
+    """ Incremental, resumable fetch of a portfolio into an output directory.
+    Numbers are fetched in chunks of checkpoint_every with the bulk endpoints.
+    After each chunk the new or changed records are written to a new batch
+    file, which is renamed into place before the checkpoint is committed;
+    batch files left by a run that died before committing are removed on
+    start up, so each committed batch is complete and no record is lost."""
+
+    def __init__(self, client, directory, sources=("biblio",), refresh_after=None,
+                 checkpoint_every=1000, batch_size=BULK_BATCH_SIZE, max_workers=1, max_attempts=3):
+        """ param EPOops client: client used for fetching
+        param string directory: output directory, created if missing
+        param tuple sources: any of SOURCES
+        param float refresh_after: seconds before completed numbers are fetched again
+        param int checkpoint_every: numbers fetched between batch writes / checkpoints
+        param int batch_size: numbers per bulk request
+        param int max_workers: bulk requests in flight at once
+        param int max_attempts: failed fetches before a number is skipped"""
+        for source in sources:
+            if source not in SOURCES:
+                raise ValueError("Unknown sync source: %s" % source)
+        self.client = client
+        self.directory = directory
+        self.sources = sources
+        self.refresh_after = refresh_after
+        self.checkpoint_every = checkpoint_every
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.checkpoint = SyncCheckpoint(os.path.join(directory, "checkpoint.db"))
+        self.remove_uncommitted()
+
+    def batch_path(self, batch):
+        return os.path.join(self.directory, "batch-%05d.jsonl" % batch)
+
+    def remove_uncommitted(self):
+        """ Delete batch files an interrupted run wrote but never checkpointed. """
+        committed = self.checkpoint.batches()
+        for path in glob.glob(os.path.join(self.directory, "batch-*.jsonl*")):
+            name = os.path.basename(path)
+            if name.endswith(".tmp") or int(name[len("batch-"):].split(".")[0]) not in committed:
+                os.remove(path)
+
+    def fetch(self, numbers, source):
+        """ Generator of (number, response) from the bulk endpoint for a source. """
+        if source == "register":
+            return self.client.get_register_bulk(numbers, batch_size=self.batch_size, max_workers=self.max_workers)
+        return self.client.get_data_bulk(numbers, batch_size=self.batch_size, max_workers=self.max_workers)
+
+    def run(self, numbers, on_record=None):
+        """ Sync a portfolio and return a summary dictionary of counts.
+        exhausted counts numbers that have failed max_attempts times in a row -
+        see SyncCheckpoint.exhausted for the details.
+        param iterable numbers: numbers in epodoc standard, e.g. from read_cases
+        param function on_record: called as on_record(number, source, data) for
+            each new or changed record once its batch is committed"""
+        numbers = list(dict.fromkeys(numbers))
+        summary = {"numbers": len(numbers), "fetched": 0, "changed": 0, "unchanged": 0, "failed": 0, "batches": 0}
+        for source in self.sources:
+            due = self.checkpoint.due(numbers, source, self.refresh_after, self.max_attempts)
+            for start in range(0, len(due), self.checkpoint_every):
+                chunk = due[start:start + self.checkpoint_every]
+                changed = self.sync_chunk(chunk, source, summary)
+                if on_record is not None:
+                    for number, data in changed:
+                        on_record(number, source, data)
+        summary["skipped"] = len(numbers) * len(self.sources) - summary["fetched"]
+        summary["exhausted"] = sum(
+            len(self.checkpoint.exhausted(numbers, source, self.max_attempts)) for source in self.sources)
+        return summary
+
+    def sync_chunk(self, numbers, source, summary):
+        """ Fetch one chunk, append its changed records and checkpoint it.
+        Returns the (number, data) pairs that were written."""
+        previous = self.checkpoint.hashes(numbers, source)
+        results = []
+        changed = []
+        fetched = time.time()
+        for number, response in self.fetch(numbers, source):
+            summary["fetched"] += 1
+            error = response_error(source, response)
+            if error is not None:
+                summary["failed"] += 1
+                results.append((number, source, None, error, False))
+                continue
+            data = response[1] if source == "register" else response
+            digest = content_hash(data)
+            is_changed = previous.get(number) != digest
+            if is_changed:
+                changed.append((number, data))
+                summary["changed"] += 1
+            else:
+                summary["unchanged"] += 1
+            results.append((number, source, digest, None, is_changed))
+
+        batch = None
+        if changed:
+            batch = self.checkpoint.next_batch()
+            path = self.batch_path(batch)
+            with open(path + ".tmp", "w") as f:
+                for number, data in changed:
+                    f.write(json.dumps({"number": number, "source": source, "fetched": fetched, "data": data}))
+                    f.write("\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(path + ".tmp", path)
+            summary["batches"] += 1
+        self.checkpoint.commit(batch, len(changed), results)
+        return changed
+
+    def close(self):
+        self.checkpoint.close()
+
+
+def iter_synced(directory, source=None, latest=True, batches=None):
+    """ Generator of (number, source, data) from the batches of a sync directory.
+    param string source: only records from this source
+    param bool latest: only the current version of each record, as recorded
+        in the checkpoint, rather than every version ever written
+    param set batches: only read these batch ids, e.g. those written since a previous read"""
+    checkpoint = SyncCheckpoint(os.path.join(directory, "checkpoint.db"))
+    try:
+        committed = checkpoint.batches()
+        if batches is not None:
+            committed &= set(batches)
+        current = None
+        if latest:
+            current = set(checkpoint.conn.execute(
+                "SELECT number, source, batch FROM documents WHERE batch IS NOT NULL").fetchall())
+    finally:
+        checkpoint.close()
+    for batch in sorted(committed):
+        with open(os.path.join(directory, "batch-%05d.jsonl" % batch)) as f:
+            for line in f:
+                record = json.loads(line)
+                if source is not None and record["source"] != source:
+                    continue
+                if current is not None and (record["number"], record["source"], batch) not in current:
+                    continue
+                yield record["number"], record["source"], record["data"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resumable sync of a portfolio from EPO OPS")
+    parser.add_argument("cases", help="file of numbers, one per line, e.g. cases.txt")
+    parser.add_argument("directory", help="output directory for batches and the checkpoint")
+    parser.add_argument("--register", action="store_true", help="also sync EP register data")
+    parser.add_argument("--refresh-days", type=float, default=None, help="re-fetch documents older than this")
+    parser.add_argument("--workers", type=int, default=1, help="bulk requests in flight at once")
+    parser.add_argument("--config", default=None, help="config.ini for EPOops")
+    args = parser.parse_args()
+
+    sources = ("biblio", "register") if args.register else ("biblio",)
+    refresh_after = args.refresh_days * 24 * 3600 if args.refresh_days is not None else None
+    with EPOops(args.config) as client:
+        sync = PortfolioSync(client, args.directory, sources, refresh_after, max_workers=args.workers)
+        try:
+            numbers = list(read_cases(args.cases))
+            summary = sync.run(numbers)
+            for source in sources:
+                for number, attempts, error in sync.checkpoint.exhausted(numbers, source, sync.max_attempts):
+                    print("%s %s failed %d times: %s" % (number, source, attempts, error), file=sys.stderr)
+        finally:
+            sync.close()
+    print(json.dumps(summary, sort_keys=True))
+
+if __name__ == "__main__":
+    main()
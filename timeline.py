@@ -0,0 +1,132 @@
+# Python 2.7 and 3+ Version
+
+# Vectorised filing timelines for portfolios of cleaned records
+#
+# Dates from many EPOops.clean_data records are gathered into NumPy
+# datetime64 arrays in one pass, so earliest priority, application to
+# publication lag and per-year filing counts are computed with array
+# operations rather than a strptime call per date per record.
+
+from __future__ import print_function
+
+import numpy as np
+
+# Days value standing in for a missing date while taking minimums
+NO_DATE = np.iinfo(np.int64).max
+
+def yyyymmdd(date):
+    """ Integer YYYYMMDD for a clean_data date string or a parsed datetime, 0 if missing. """
+    if not date:
+        return 0
+    if hasattr(date, "year"):
+        return date.year * 10000 + date.month * 100 + date.day
+    try:
+        return int(date) if len(date) == 8 else 0
+    except ValueError:
+        return 0
+
+def to_datetime64(values):
+    """ Convert an array of YYYYMMDD integers to datetime64[D], with NaT where 0
+    or not a real date. Each distinct value is converted once. """
+    values = np.asarray(values, dtype=np.int64)
+    unique, inverse = np.unique(values, return_inverse=True)
+    years = unique // 10000
+    months = unique // 100 % 100
+    days = unique % 100
+    valid = (years > 0) & (months >= 1) & (months <= 12) & (days >= 1) & (days <= 31)
+    safe_years = np.where(valid, years, 1970)
+    converted = ((safe_years - 1970).astype("datetime64[Y]").astype("datetime64[M]")
+                 + np.where(valid, months - 1, 0).astype("timedelta64[M]")).astype("datetime64[D]")
+    converted = converted + np.where(valid, days - 1, 0).astype("timedelta64[D]")
+    # Days past the end of the month roll over, e.g. 20150231 -> 2015-03-03 - reject
+    # any date whose day of the month does not survive the conversion
+    valid &= (converted - converted.astype("datetime64[M]")).astype(np.int64) + 1 == days
+    converted[~valid] = np.datetime64("NaT")
+    return converted[inverse.reshape(-1)]
+
+
+class Timeline():
+    """ Date arrays for a portfolio of records, one element per record.
+    Records with no usable date get NaT rather than raising; missing() gives
+    a mask of them for explicit handling.
+    Attributes: numbers, publication_date, application_date, earliest_priority"""
+
+    def __init__(self, numbers, publication_date, application_date, earliest_priority):
+        self.numbers = numbers
+        self.publication_date = publication_date
+        self.application_date = application_date
+        self.earliest_priority = earliest_priority
+
+    @classmethod
+    def from_records(cls, records):
+        """ Build a timeline from clean_data dictionaries or PatentRecords.
+        clean_data error strings are skipped."""
+        numbers = []
+        publication = []
+        application = []
+        other_rows = []
+        other_dates = []
+        for record in records:
+            if isinstance(record, str):
+                continue
+            row = len(numbers)
+            if isinstance(record, dict):
+                publications = [(ref["number"], ref["date"]) for ref in record["publication"]]
+                applications = [ref["date"] for ref in record["application"]]
+                priorities = [ref["date"] for ref in record["priorityclaims"]]
+            else:
+                publications = [(ref.number, ref.date) for ref in record.publication]
+                applications = [ref.date for ref in record.application]
+                priorities = [ref.date for ref in record.priorityclaims]
+            numbers.append(publications[0][0] if publications else None)
+            publication.append(yyyymmdd(publications[0][1]) if publications else 0)
+            application.append(yyyymmdd(applications[0]) if applications else 0)
+            for date in applications + priorities:
+                other_rows.append(row)
+                other_dates.append(yyyymmdd(date))
+
+        # Earliest of all application and priority dates per record
+        dates = to_datetime64(other_dates)
+        days = dates.astype(np.int64)
+        days[np.isnat(dates)] = NO_DATE
+        earliest = np.full(len(numbers), NO_DATE, dtype=np.int64)
+        np.minimum.at(earliest, np.asarray(other_rows, dtype=np.intp), days)
+        earliest_priority = earliest.astype("datetime64[D]")
+        earliest_priority[earliest == NO_DATE] = np.datetime64("NaT")
+
+        return cls(numbers, to_datetime64(publication), to_datetime64(application), earliest_priority)
+
+    @classmethod
+    def from_columnar(cls, reader):
+        """ Build a timeline from a columnar.ColumnarReader export, which
+        already stores integer-encoded publication, application and earliest dates. """
+        numbers = []
+        for part in reader.parts:
+            strings = part.strings("documents.publication")
+            numbers.extend(strings.take(range(part.rows)))
+        return cls(
+            numbers,
+            to_datetime64(reader.column("documents", "pub_date")),
+            to_datetime64(reader.column("documents", "application_date")),
+            to_datetime64(reader.column("documents", "earliest_date"))
+        )
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def missing(self, date="earliest_priority"):
+        """ Mask of records with no value for a date attribute. """
+        return np.isnat(getattr(self, date))
+
+    def publication_lag(self, start="earliest_priority"):
+        """ Days from a start date (earliest_priority or application_date) to
+        publication, as timedelta64[D] with NaT where either is missing. """
+        return self.publication_date - getattr(self, start)
+
+    def filing_histogram(self, date="earliest_priority"):
+        """ (years, counts) arrays of records per year of a date attribute,
+        ignoring records without that date. """
+        dates = getattr(self, date)
+        dates = dates[~np.isnat(dates)]
+        years = dates.astype("datetime64[Y]").astype(np.int64) + 1970
+        return np.unique(years, return_counts=True)